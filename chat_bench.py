@@ -0,0 +1,541 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from chat_protocol import LINE_JSON, codec_from_response, hello_request
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+BENCH_PASSWORD = 'bench-password'
+MARKER = 'bench|'
+READ_LIMIT = 16 * 1024 * 1024
+
+# --- Stats helpers ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, int(round(p * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'mean_ms': (sum(values) / len(values) * 1000) if values else None,
+        'p50_ms': _ms(percentile(values, 0.50)),
+        'p99_ms': _ms(percentile(values, 0.99)),
+        'p999_ms': _ms(percentile(values, 0.999)),
+        'max_ms': _ms(values[-1] if values else None),
+    }
+
+def _ms(v):
+    return None if v is None else v * 1000
+
+# --- Room shapes ---
+def assign_rooms(n_users, n_rooms, shape):
+    # returns the room name for each user
+    if shape == 'single':
+        return ['bench_room_0'] * n_users
+    if shape == 'zipf':
+        # a few very busy rooms and a long tail of small ones
+        weights = [1.0 / (i + 1) for i in range(n_rooms)]
+        return [f'bench_room_{random.choices(range(n_rooms), weights)[0]}' for _ in range(n_users)]
+    return [f'bench_room_{i % n_rooms}' for i in range(n_users)]
+
+# --- Simulated user ---
+class BenchUser:
+    def __init__(self, bench, index, room):
+        self.bench = bench
+        self.index = index
+        self.username = f'bench_{index}'
+        self.room = room
+        self.reader = None
+        self.writer = None
+        self.waiters = {}  # response type -> future
+        self.seq = 0
+        self.listener = None
+        self.send_lock = asyncio.Lock()  # raw upload bytes must not interleave with other frames
+        self.codec = LINE_JSON
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.bench.host, self.bench.port, limit=READ_LIMIT)
+        protocol = self.bench.args.protocol
+        if protocol != 'json':
+            await self._write(LINE_JSON.encode(hello_request(compress=protocol == 'binary+zlib')))
+            reply, _ = await LINE_JSON.read(self.reader)
+            self.codec = codec_from_response(reply or {})
+            if self.codec is None:
+                raise RuntimeError(f'server refused {protocol} framing: {reply}')
+        self.listener = asyncio.create_task(self.listen())
+
+    async def send(self, obj):
+        data = self.codec.encode(obj)
+        self.bench.bytes_out += len(data)
+        async with self.send_lock:
+            await self._write(data)
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def request(self, obj, response_type, timeout=60):
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[response_type] = fut
+        await self.send(obj)
+        return await asyncio.wait_for(fut, timeout)
+
+    def expect(self, response_type):
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[response_type] = fut
+        return fut
+
+    async def listen(self):
+        try:
+            while True:
+                msg, size = await self.codec.read(self.reader)
+                if msg is None:
+                    break
+                self.bench.bytes_in += size
+                mtype = msg.get('type')
+                if mtype == 'message':
+                    self.bench.on_message(msg)
+                elif mtype == 'file_shared':
+                    self.bench.on_file_shared(self, msg)
+                fut = self.waiters.pop(mtype, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def login(self):
+        resp = await self.request({'type': 'login', 'username': self.username, 'password': BENCH_PASSWORD}, 'login_response')
+        if resp.get('ok'):
+            return True
+        if resp.get('reason') == 'busy_retry':
+            await asyncio.sleep(0.5)
+            return await self.login()
+        await self.request({'type': 'register', 'username': self.username, 'password': BENCH_PASSWORD}, 'register_response')
+        resp = await self.request({'type': 'login', 'username': self.username, 'password': BENCH_PASSWORD}, 'login_response')
+        return bool(resp.get('ok'))
+
+    async def join(self):
+        history = self.expect('history')
+        t0 = time.perf_counter()
+        await self.send({'type': 'join', 'room': self.room})
+        await asyncio.wait_for(history, 60)
+        self.bench.join_latencies.append(time.perf_counter() - t0)
+
+    async def chat(self, rate, stop_at):
+        # Poisson arrivals at `rate` messages per second
+        while time.perf_counter() < stop_at:
+            await asyncio.sleep(random.expovariate(rate))
+            self.seq += 1
+            text = f'{MARKER}{self.index}|{self.seq}|{time.perf_counter():.9f}'
+            await self.send({'type': 'message', 'text': text})
+            self.bench.sent += 1
+
+    async def upload(self, size):
+        filename = f'bench_{self.index}_{self.seq}.bin'
+        self.seq += 1
+        payload = os.urandom(min(size, 1024 * 1024))
+        ready = self.expect('file_ready')
+        t0 = time.perf_counter()
+        done = asyncio.get_running_loop().create_future()
+        self.bench.pending_uploads[filename] = done
+        async with self.send_lock:
+            await self._write(self.codec.encode({'type': 'file_meta', 'meta': {'filename': filename, 'size': size}}))
+            await asyncio.wait_for(ready, 60)
+            remaining = size
+            while remaining > 0:
+                chunk = payload[:remaining]
+                await self._write(chunk)
+                remaining -= len(chunk)
+        await asyncio.wait_for(done, 300)
+        elapsed = time.perf_counter() - t0
+        self.bench.uploads.append({'bytes': size, 'seconds': elapsed})
+
+    async def list_rooms(self):
+        t0 = time.perf_counter()
+        await self.request({'type': 'list_rooms'}, 'rooms')
+        self.bench.list_rooms_latencies.append(time.perf_counter() - t0)
+
+    async def close(self):
+        if self.listener:
+            self.listener.cancel()
+        if self.writer:
+            self.writer.close()
+
+# --- Benchmark driver ---
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.host = args.host
+        self.port = args.port
+        self.sent = 0
+        self.delivered = 0
+        self.latencies = []
+        self.join_latencies = []
+        self.list_rooms_latencies = []
+        self.uploads = []
+        self.pending_uploads = {}
+        self.measuring = False
+        self.bytes_in = 0       # frame bytes only; raw upload payloads are not counted
+        self.bytes_out = 0
+        self.server_pid = None  # set when the bench spawned the server, for its CPU time
+
+    def on_message(self, msg):
+        text = msg.get('text') or ''
+        if not text.startswith(MARKER):
+            return
+        self.delivered += 1
+        if self.measuring:
+            self.latencies.append(time.perf_counter() - float(text.rsplit('|', 1)[1]))
+
+    def on_file_shared(self, user, msg):
+        fut = self.pending_uploads.pop(msg.get('filename'), None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+
+    async def run(self):
+        args = self.args
+        started_at = datetime.utcnow().isoformat()
+        room_names = assign_rooms(args.users, args.rooms, args.room_shape)
+        users = [BenchUser(self, i, room_names[i]) for i in range(args.users)]
+
+        t0 = time.perf_counter()
+        sem = asyncio.Semaphore(args.login_concurrency)
+
+        async def setup(u):
+            async with sem:
+                await u.connect()
+                if not await u.login():
+                    raise RuntimeError(f'login failed for {u.username}')
+                await u.join()
+        await asyncio.gather(*(setup(u) for u in users))
+        setup_seconds = time.perf_counter() - t0
+        print(f'{len(users)} users connected and joined in {setup_seconds:.1f}s')
+
+        self.measuring = True
+        start = time.perf_counter()
+        bytes_in, bytes_out = self.bytes_in, self.bytes_out
+        cpu_start = time.process_time()
+        server_cpu_start = process_cpu_seconds(self.server_pid)
+        stop_at = start + args.duration
+        tasks = [asyncio.create_task(u.chat(args.rate, stop_at)) for u in users]
+        uploaders = users[:args.uploads]
+        tasks += [asyncio.create_task(u.upload(args.file_size)) for u in uploaders]
+        tasks += [asyncio.create_task(u.list_rooms()) for u in users[:args.list_rooms]]
+        await asyncio.gather(*tasks)
+        # let in-flight messages land before we stop counting
+        await asyncio.sleep(args.settle)
+        elapsed = time.perf_counter() - start
+        self.measuring = False
+        client_cpu = time.process_time() - cpu_start
+        server_cpu_end = process_cpu_seconds(self.server_pid)
+        server_cpu = server_cpu_end - server_cpu_start if server_cpu_end is not None and server_cpu_start is not None else None
+        bytes_in, bytes_out = self.bytes_in - bytes_in, self.bytes_out - bytes_out
+
+        for u in users:
+            await u.close()
+
+        upload_bytes = sum(u['bytes'] for u in self.uploads)
+        upload_seconds = sum(u['seconds'] for u in self.uploads)
+        return {
+            'config': vars(args),
+            'started_at': started_at,
+            'setup_seconds': setup_seconds,
+            'elapsed_seconds': elapsed,
+            'messages_sent': self.sent,
+            'messages_delivered': self.delivered,
+            'send_rate': self.sent / elapsed,
+            'delivery_rate': self.delivered / elapsed,
+            'latency': summarize(self.latencies),
+            'join_latency': summarize(self.join_latencies),
+            'list_rooms_latency': summarize(self.list_rooms_latencies),
+            'uploads': {
+                'count': len(self.uploads),
+                'bytes': upload_bytes,
+                'mb_per_s': (upload_bytes / upload_seconds / 1e6) if upload_seconds else None,
+            },
+            # per delivered message, over the measured phase
+            'wire': {
+                'protocol': args.protocol,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'bytes_in_per_msg': bytes_in / self.delivered if self.delivered else None,
+                'bytes_out_per_msg': bytes_out / self.sent if self.sent else None,
+                'client_cpu_us_per_msg': client_cpu / self.delivered * 1e6 if self.delivered else None,
+                'server_cpu_us_per_msg': server_cpu / self.delivered * 1e6 if self.delivered and server_cpu is not None else None,
+            },
+        }
+
+# --- CPU / memory accounting ---
+def _server_stats(pid):
+    # /proc/<pid>/stat fields (after the name) for pid and its direct children (--workers)
+    if pid is None or not os.path.isdir('/proc'):
+        return None
+    procs = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # fields[1] is ppid
+        if int(entry) == pid or int(fields[1]) == pid:
+            procs.append(fields)
+    return procs
+
+def process_cpu_seconds(pid):
+    # user+system time, from /proc; None elsewhere
+    procs = _server_stats(pid)
+    if procs is None:
+        return None
+    # utime and stime are the 12th and 13th fields after the name
+    return sum(int(f[11]) + int(f[12]) for f in procs) / os.sysconf('SC_CLK_TCK')
+
+def process_rss_bytes(pid):
+    procs = _server_stats(pid)
+    if procs is None:
+        return None
+    # rss (in pages) is the 22nd field after the name
+    return sum(int(f[21]) for f in procs) * os.sysconf('SC_PAGE_SIZE')
+
+# --- Idle connections ---
+async def idle_bench(args, server_pid):
+    # hold --idle mostly-silent connections open and report server memory per connection
+    await asyncio.sleep(1)
+    before = process_rss_bytes(server_pid)
+    conns = []
+    t0 = time.perf_counter()
+    for i in range(args.idle):
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        conns.append(writer)
+    connect_seconds = time.perf_counter() - t0
+    await asyncio.sleep(2)
+    after = process_rss_bytes(server_pid)
+    for writer in conns:
+        writer.close()
+    return {
+        'connections': len(conns),
+        'connect_seconds': connect_seconds,
+        'server_rss_before': before,
+        'server_rss_after': after,
+        'bytes_per_connection': (after - before) / len(conns) if before is not None and conns else None,
+    }
+
+# --- Pipelining check ---
+async def pipeline_check(args):
+    # register, login and three requests that need the login, written in one go
+    # the way a reconnecting client queues them: every later reply has to come
+    # after the login_response and none may be not_authenticated.
+    # Returns a list of problems, empty when the server gets it right.
+    username = f'bench_pipeline_{os.getpid()}_{int(time.time())}'
+    frames = [
+        {'type': 'register', 'username': username, 'password': BENCH_PASSWORD, 'rid': 1},
+        {'type': 'login', 'username': username, 'password': BENCH_PASSWORD, 'rid': 2},
+        {'type': 'list_rooms', 'rid': 3},
+        {'type': 'history_before', 'room': 'main', 'before_id': 1, 'rid': 4},
+        {'type': 'upload_chunk', 'upload_id': 'none', 'offset': 0, 'size': 1, 'rid': 5},
+    ]
+    reader, writer = await asyncio.open_connection(args.host, args.port, limit=READ_LIMIT)
+    replies = {}  # rid -> (position, first reply)
+    try:
+        writer.write(b''.join(LINE_JSON.encode(f) for f in frames) + b'x')  # the chunk's one raw byte
+        await writer.drain()
+        while len(replies) < len(frames):
+            msg, _ = await asyncio.wait_for(LINE_JSON.read(reader), 60)
+            if msg is None:
+                break
+            if msg.get('rid') in range(1, len(frames) + 1):
+                replies.setdefault(msg['rid'], (len(replies), msg))
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+    problems = []
+    login = replies.get(2)
+    if login is None or not login[1].get('ok'):
+        return [f'login failed: {login[1]}' if login else 'no login_response (connection dropped?)']
+    for frame in frames[2:]:
+        reply = replies.get(frame['rid'])
+        if reply is None:
+            problems.append(f"{frame['type']}: no reply (connection dropped?)")
+        elif reply[1].get('reason') == 'not_authenticated' or reply[0] < login[0]:
+            problems.append(f"{frame['type']}: answered before the login: {reply[1]}")
+    return problems
+
+# --- Room registry ---
+def registry_bench(n, n_rooms):
+    # in-process cost of Session + RoomRegistry: memory per idle member and join/leave time
+    import tracemalloc
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from server1 import RoomRegistry, Session
+    writers = [object() for _ in range(n)]  # stand-ins for StreamWriters, allocated outside the trace
+    names = [f'bench_room_{i % n_rooms}' for i in range(n)]
+    registry = RoomRegistry()
+    sessions = {}
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    t0 = time.perf_counter()
+    for w, room in zip(writers, names):
+        s = sessions[w] = Session(f'user_{id(w)}')
+        s.room = room
+        registry.join(room, w)
+    join_seconds = time.perf_counter() - t0
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    # move everyone one room over, then empty the registry
+    t0 = time.perf_counter()
+    for w, room in zip(writers, names):
+        registry.leave(room, w)
+        registry.join(room + '_b', w)
+    move_seconds = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for w, room in zip(writers, names):
+        registry.leave(room + '_b', w)
+    leave_seconds = time.perf_counter() - t0
+    return {
+        'members': n,
+        'rooms': n_rooms,
+        'bytes_per_member': used / n,
+        'join_us': join_seconds / n * 1e6,
+        'move_us': move_seconds / n * 1e6,
+        'leave_us': leave_seconds / n * 1e6,
+        'rooms_left': len(registry),
+    }
+
+# --- Local server ---
+def spawn_server(port, workers=1):
+    # run server1.py in a scratch directory so its database and uploads stay out of the tree
+    workdir = tempfile.mkdtemp(prefix='chat_bench_')
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server1.py')
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    proc = subprocess.Popen([sys.executable, server_py, '--workers', str(workers), '--port', str(port)],
+                            cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            print(f'Spawned server1.py in {workdir}')
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f'server did not start, see {workdir}/server.log')
+
+def print_report(result, baseline=None):
+    def line(name, key, stat):
+        cur = result[key][stat]
+        text = f'  {name:<22}{cur:10.2f}' if cur is not None else f'  {name:<22}{"-":>10}'
+        if baseline and baseline.get(key, {}).get(stat):
+            text += f'   (baseline {baseline[key][stat]:.2f}, {(cur - baseline[key][stat]) / baseline[key][stat] * 100:+.1f}%)'
+        print(text)
+
+    print(f"sent {result['messages_sent']} msgs ({result['send_rate']:.0f}/s), "
+          f"delivered {result['messages_delivered']} ({result['delivery_rate']:.0f}/s)")
+    for stat in ('p50_ms', 'p99_ms', 'p999_ms'):
+        line(f'latency {stat}', 'latency', stat)
+    for stat in ('p50_ms', 'p99_ms'):
+        line(f'join {stat}', 'join_latency', stat)
+    if result['uploads']['count']:
+        print(f"  upload throughput     {result['uploads']['mb_per_s']:10.2f} MB/s")
+    print(f"  wire protocol         {result['wire']['protocol']:>10}")
+    for stat in ('bytes_in_per_msg', 'bytes_out_per_msg', 'client_cpu_us_per_msg', 'server_cpu_us_per_msg'):
+        line(stat.replace('_', ' '), 'wire', stat)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description='Headless load generator for the chat server')
+    p.add_argument('--host', default=DEFAULT_HOST)
+    p.add_argument('--port', type=int, default=DEFAULT_PORT)
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--rooms', type=int, default=10)
+    p.add_argument('--room-shape', choices=('uniform', 'zipf', 'single'), default='uniform')
+    p.add_argument('--rate', type=float, default=1.0, help='messages per second per user')
+    p.add_argument('--duration', type=float, default=10.0, help='seconds of measured traffic')
+    p.add_argument('--settle', type=float, default=2.0, help='seconds to wait for in-flight messages')
+    p.add_argument('--uploads', type=int, default=0, help='number of users that upload a file')
+    p.add_argument('--file-size', type=int, default=4 * 1024 * 1024)
+    p.add_argument('--list-rooms', type=int, default=10, help='number of users that issue list_rooms')
+    p.add_argument('--login-concurrency', type=int, default=32)
+    p.add_argument('--spawn-server', action='store_true', help='start a throwaway local server1.py')
+    p.add_argument('--server-workers', type=int, default=1, help='--workers for the spawned server')
+    p.add_argument('--protocol', choices=('json', 'binary', 'binary+zlib'), default='json',
+                   help='line JSON, or negotiated length-prefixed frames (msgpack if installed), optionally zlib')
+    p.add_argument('--idle', type=int, default=0,
+                   help='instead of chat traffic, open this many idle connections and report server memory per connection')
+    p.add_argument('--registry', type=int, default=0,
+                   help='instead of a load test, benchmark the in-process room registry with this many members')
+    p.add_argument('--check-pipeline', action='store_true',
+                   help='instead of a load test, check that requests pipelined behind a login wait for it (exit 1 if not)')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--out', help='write results as JSON to this file')
+    p.add_argument('--baseline', help='compare against a previous --out file')
+    return p.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    if args.registry:
+        result = registry_bench(args.registry, args.rooms)
+        for key, value in result.items():
+            print(f'  {key:<22}{value:10.2f}' if isinstance(value, float) else f'  {key:<22}{value:10}')
+        return
+    proc = spawn_server(args.port, args.server_workers) if args.spawn_server else None
+    if args.idle:
+        try:
+            result = asyncio.run(idle_bench(args, proc.pid if proc else None))
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait(10)
+        per_conn = result['bytes_per_connection']
+        print(f"{result['connections']} idle connections opened in {result['connect_seconds']:.1f}s; "
+              f"server memory per connection: {per_conn / 1024:.1f} KiB" if per_conn is not None else
+              "server memory needs --spawn-server on Linux")
+        return
+    if args.check_pipeline:
+        try:
+            problems = asyncio.run(pipeline_check(args))
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait(10)
+        for line in problems:
+            print('FAIL', line)
+        if problems:
+            sys.exit(1)
+        print('Pipelined login: later requests waited for it')
+        return
+    try:
+        bench = Bench(args)
+        bench.server_pid = proc.pid if proc else None
+        result = asyncio.run(bench.run())
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+        print('Results written to', args.out)
+
+if __name__ == '__main__':
+    main()
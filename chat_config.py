@@ -0,0 +1,133 @@
+import json
+import os
+
+# Settings shared by server1.py and client1.py.
+#
+# A script's settings are its UPPER_CASE module constants holding plain values
+# (numbers, strings, booleans, None, lists/tuples and dicts). The constant is the
+# default; each layer below overrides the one before it:
+#
+#   1. a JSON config file: {"PORT": 9000, "db_readers": 8, ...} (names are
+#      case-insensitive)
+#   2. environment variables: <prefix><NAME>, e.g. CHAT_PORT=9000
+#   3. the command line: --set NAME=VALUE, plus the scripts' own shortcut flags
+#
+# Environment and command line values are parsed as JSON (8, true, null, [1, 2],
+# {"message": [5, 10]}) unless the default is a string, which takes them as-is.
+# A setting that defaults to None takes the type its script declares for it in
+# the `types` table passed to apply_settings (None stays allowed); without one,
+# any value is accepted.
+
+PLAIN = (bool, int, float, str, list, tuple, dict, type(None))
+
+class ConfigError(ValueError):
+    pass
+
+def settings_of(namespace):
+    # names of the tunable constants in a module's globals(), in definition order
+    return tuple(name for name, value in namespace.items()
+                 if name.isupper() and not name.startswith('_') and isinstance(value, PLAIN))
+
+def coerce(name, default, value, kind=None):
+    # convert `value` to the type of the default, or to `kind` for a setting that
+    # defaults to None, or raise ConfigError; None is accepted for any setting
+    kind = kind or type(default)
+    if value is None or kind is type(None):
+        return value
+    if issubclass(kind, bool):
+        if isinstance(value, bool):
+            return value
+    elif issubclass(kind, (int, float)):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if issubclass(kind, int) and value != int(value):
+                raise ConfigError(f'{name} must be a whole number, got {value!r}')
+            return kind(value)
+    elif issubclass(kind, str):
+        if isinstance(value, str):
+            return value
+    elif issubclass(kind, (list, tuple)):
+        if isinstance(value, (list, tuple)):
+            return kind(value)
+    elif issubclass(kind, dict):
+        if isinstance(value, dict):
+            return value
+    raise ConfigError(f'{name} must be of type {kind.__name__}, got {value!r}')
+
+def parse(default, raw, kind=None):
+    if isinstance(default, str) or kind is str:
+        return raw
+    try:
+        return json.loads(raw)
+    except ValueError:
+        # a bare word for a setting that defaults to None (a path, say)
+        return raw
+
+def load_file(path, names, required=False):
+    # {NAME: value} from a JSON config file; a missing optional file is empty
+    if not os.path.exists(path):
+        if required:
+            raise ConfigError(f'config file {path} not found')
+        return {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    except ValueError as e:
+        raise ConfigError(f'{path}: {e}')
+    if not isinstance(data, dict):
+        raise ConfigError(f'{path}: expected a JSON object of settings')
+    values = {}
+    for key, value in data.items():
+        name = key.upper()
+        if name not in names:
+            raise ConfigError(f'{path}: unknown setting {key!r}')
+        values[name] = value
+    return values
+
+def apply_settings(namespace, names, path=None, required=False, env_prefix='CHAT_', overrides=(), types=None):
+    # update `namespace` in place; returns {NAME: source} for every overridden setting.
+    # `overrides` is a list of (NAME, value) pairs from the command line; string
+    # values are parsed the same way as environment variables. `types` declares
+    # {NAME: type} for settings whose default is None, so their values are checked too.
+    types = types or {}
+    layers = [(name, value, path) for name, value in (load_file(path, names, required) if path else {}).items()]
+    for name in names:
+        raw = os.environ.get(env_prefix + name)
+        if raw is not None:
+            layers.append((name, parse(namespace[name], raw, types.get(name)), f'env {env_prefix}{name}'))
+    for name, raw in overrides:
+        name = name.strip().upper()
+        if name not in names:
+            raise ConfigError(f'unknown setting {name!r}')
+        value = parse(namespace[name], raw, types.get(name)) if isinstance(raw, str) else raw
+        layers.append((name, value, 'command line'))
+
+    sources = {}
+    for name, value, source in layers:
+        namespace[name] = coerce(name, namespace[name], value, types.get(name))
+        sources[name] = source
+    return sources
+
+def parse_assignments(items):
+    # ['NAME=VALUE', ...] from --set into (NAME, VALUE) pairs
+    pairs = []
+    for item in items:
+        name, sep, raw = item.partition('=')
+        if not sep or not name.strip():
+            raise ConfigError(f'expected NAME=VALUE, got {item!r}')
+        pairs.append((name, raw))
+    return pairs
+
+def format_settings(namespace, names, sources, always=()):
+    # report lines for the settings in `always` plus every overridden one
+    lines = []
+    for name in names:
+        if name in always or name in sources:
+            line = f'  {name} = {namespace[name]!r}'
+            if name in sources:
+                line += f'   ({sources[name]})'
+            lines.append(line)
+    return lines
+
+def dump_settings(namespace, names):
+    # the effective settings as a config file would spell them
+    return json.dumps({name: namespace[name] for name in names}, indent=2, default=str)
@@ -0,0 +1,475 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import queue
+import ssl
+import threading
+import time
+
+from chat_protocol import LINE_JSON, codec_from_response, hello_request
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+USE_TLS = False
+CHUNK_SIZE = 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024   # bytes per checksummed upload chunk
+UPLOAD_WINDOW = 4                 # chunks in flight before waiting for an ack
+RECONNECT_MAX_DELAY = 30          # seconds between reconnect attempts, at most
+READ_LIMIT = 16 * 1024 * 1024     # longest frame we accept from the server
+PROTOCOL = "binary"               # "binary" asks for length-prefixed frames, "json" stays on lines
+COMPRESS = True                   # ask for zlib on large binary frames
+
+
+# ============================================================
+#                     HEADLESS CLIENT ENGINE
+# ============================================================
+#
+# ChatEngine owns the connection: framing, the send queue, reconnects, uploads
+# and downloads all run on an asyncio loop in a background thread. Whoever
+# drives it (the Tk GUI, a script, a test) calls the thread-safe methods below
+# and reads (kind, payload) tuples from `engine.events`:
+#
+#   ("connected", None)            ("disconnected", reason)
+#   ("reconnected", None)          ("error", text)
+#   ("server", msg)                every frame from the server, as a dict
+#   ("upload_progress", {...})     ("upload_done", {...})     ("upload_failed", {...})
+#   ("download_progress", {...})   ("download_done", {...})   ("download_failed", {...})
+
+class ChatEngine:
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, use_tls=USE_TLS, events=None, auto_reconnect=True,
+                 protocol=PROTOCOL, compress=COMPRESS):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.protocol = protocol
+        self.compress = compress
+        self.codec = LINE_JSON          # wire format of the current connection
+        self.events = events if events is not None else queue.Queue()
+        self.auto_reconnect = auto_reconnect
+
+        self.loop = None
+        self.thread = None
+        self.reader = None
+        self.writer = None
+        self.send_queue = None
+        self.tasks = []
+        self.connected = False
+        self.closing = False
+
+        self.credentials = None         # (username, password) once a login succeeded
+        self.token = None               # session token from the server, used to resume
+        self.room = None                # last joined room, rejoined after a reconnect
+        self.last_id = None             # newest message id seen in that room, for since_id
+        self.catch_up = None            # ids delivered live while since_id pages are still coming
+        self.pending_login = None
+        self.relogin = False            # swallow the login_response of an automatic re-login
+        self.upload_replies = None      # asyncio.Queue of upload_* replies while an upload runs
+        self.rids = itertools.count(1)
+        self.replies = {}               # rid -> concurrent Future for request()
+        self.downloads = {}             # file id -> {"path", "part", "filename"}
+
+    # -----------------------------------------------------------
+    # Lifecycle
+    # -----------------------------------------------------------
+    def start(self):
+        if self.thread:
+            return
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._thread_main, args=(ready,), name="chat-engine", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _thread_main(self, ready):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.send_queue = asyncio.Queue()
+        ready.set()
+        self.loop.run_forever()
+        # let cancelled tasks unwind before the loop goes away
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        if not self.loop:
+            return
+        self.closing = True
+        self.loop.call_soon_threadsafe(self._close_connection)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+    def _submit(self, coro):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # -----------------------------------------------------------
+    # Public, thread-safe API
+    # -----------------------------------------------------------
+    def connect(self):
+        # returns a concurrent Future resolving to True/False
+        return self._submit(self._connect())
+
+    def send(self, obj):
+        self.start()
+        # encoded by the write loop, once the connection's codec is known
+        self.loop.call_soon_threadsafe(self.send_queue.put_nowait, (obj, b""))
+        if obj.get("type") == "login":
+            self.pending_login = (obj.get("username"), obj.get("password"))
+        elif obj.get("type") == "join":
+            self.room = obj.get("room")
+            self.last_id = None
+            self.catch_up = None
+
+    def request(self, obj):
+        # tags obj with a fresh rid; the Future gets the first reply echoing it,
+        # so independent requests can be pipelined and answered in any order
+        rid = next(self.rids)
+        fut = self.replies[rid] = concurrent.futures.Future()
+        self.send(dict(obj, rid=rid))
+        return fut
+
+    def login(self, username, password, register=False):
+        self.send({"type": "register" if register else "login", "username": username, "password": password})
+
+    def upload(self, path):
+        return self._submit(self._upload(path))
+
+    def download(self, file_id, path, filename=None):
+        return self._submit(self._download(file_id, path, filename or os.path.basename(path)))
+
+    def next_event(self, timeout=None):
+        # convenience for scripts: block until the next event
+        return self.events.get(timeout=timeout)
+
+    def emit(self, kind, payload=None):
+        self.events.put((kind, payload))
+
+    # -----------------------------------------------------------
+    # Connection
+    # -----------------------------------------------------------
+    async def _open(self):
+        ctx = ssl.create_default_context() if self.use_tls else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=ctx, server_hostname=self.host if ctx else None, limit=READ_LIMIT)
+        self.codec = LINE_JSON
+        if self.protocol == "binary":
+            await self._negotiate()
+        self.connected = True
+        self.tasks = [asyncio.ensure_future(self._write_loop(self.writer)),
+                      asyncio.ensure_future(self._read_loop(self.reader))]
+
+    async def _connect(self):
+        if self.connected:
+            return True
+        try:
+            await self._open()
+        except Exception as e:
+            self.emit("error", f"Connection failed: {e}")
+            return False
+        self.emit("connected")
+        return True
+
+    async def _negotiate(self):
+        # ask for binary frames; anything but an ok hello_response keeps line JSON
+        self.writer.write(LINE_JSON.encode(hello_request(self.compress)))
+        await self.writer.drain()
+        try:
+            reply, _ = await asyncio.wait_for(LINE_JSON.read(self.reader), 10)
+        except ValueError:
+            return
+        if reply is None:
+            raise ConnectionError("closed during hello")
+        self.codec = codec_from_response(reply) or LINE_JSON
+
+    def _close_connection(self):
+        self.connected = False
+        # the writer task must not take frames meant for the next connection
+        if self.tasks:
+            self.tasks[0].cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def _write_loop(self, writer):
+        # the only place that writes to the socket, so frames never interleave
+        try:
+            while True:
+                obj, raw = await self.send_queue.get()
+                writer.write(self.codec.encode(obj) + raw)
+                await writer.drain()
+        except Exception:
+            pass
+
+    async def _read_loop(self, reader):
+        reason = "closed by server"
+        try:
+            while True:
+                try:
+                    msg, _ = await self.codec.read(reader)
+                except ValueError:
+                    continue
+                if msg is None:
+                    break
+                if msg.get("type") == "file_data":
+                    await self._receive_download(reader, msg)
+                    continue
+                self._dispatch(msg)
+        except Exception as e:
+            reason = str(e) or type(e).__name__
+        self._close_connection()
+        replies, self.replies = self.replies, {}
+        for fut in replies.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError(reason))
+        if self.upload_replies is not None:
+            self.upload_replies.put_nowait({"type": "upload_error", "reason": "disconnected", "offset": 0})
+        if self.closing:
+            return
+        self.emit("disconnected", reason)
+        if self.auto_reconnect and self.credentials:
+            asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while not self.closing:
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+            except Exception:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            # resume (or log back in) and rejoin before anything still queued goes out
+            if self.token:
+                frames = [{"type": "resume", "token": self.token, "room": self.room, "last_id": self.last_id or 0}]
+                self.catch_up = set() if self.room and self.last_id else None
+            else:
+                frames = self._relogin_frames()
+            queued = []
+            while not self.send_queue.empty():
+                queued.append(self.send_queue.get_nowait())
+            for obj in frames:
+                self.send_queue.put_nowait((obj, b""))
+            for data in queued:
+                self.send_queue.put_nowait(data)
+            return
+
+    def _relogin_frames(self):
+        username, password = self.credentials
+        self.relogin = True
+        frames = [{"type": "login", "username": username, "password": password}]
+        if self.room:
+            join = {"type": "join", "room": self.room}
+            if self.last_id is not None:
+                join["since_id"] = self.last_id   # only replay what we missed
+                self.catch_up = set()
+            frames.append(join)
+        return frames
+
+    def _dispatch(self, msg):
+        mtype = msg.get("type")
+        fut = self.replies.pop(msg.get("rid"), None)
+        if fut is not None and not fut.done():
+            fut.set_result(msg)
+        if mtype == "resume_response":
+            if msg.get("ok"):
+                self.token = msg.get("token") or self.token
+                self.emit("reconnected")
+            else:
+                # token expired or the key changed: fall back to the password
+                self.token = None
+                for obj in self._relogin_frames():
+                    self.send_queue.put_nowait((obj, b""))
+            return
+        if mtype == "login_response":
+            if msg.get("ok") and self.pending_login:
+                self.credentials = self.pending_login
+                self.token = msg.get("token")
+            if self.relogin:
+                self.relogin = False
+                self.emit("reconnected" if msg.get("ok") else "error",
+                          None if msg.get("ok") else "Automatic re-login failed")
+                return
+        elif mtype == "history" and msg.get("since_id") is not None:
+            if msg.get("room") == self.room:
+                msg = self._catch_up(msg)
+        elif mtype in ("message", "history"):
+            ids = [m["id"] for m in msg.get("messages", ())] if mtype == "history" else [msg.get("id")]
+            ids = [i for i in ids if i is not None]
+            if ids and msg.get("room") == self.room:
+                if self.catch_up is not None:
+                    # the cursor follows the catch-up pages, not the live stream
+                    self.catch_up.update(ids)
+                else:
+                    self.last_id = max(ids + [self.last_id or 0])
+        elif mtype in ("upload_ready", "upload_ack", "upload_error", "upload_done"):
+            if self.upload_replies is not None:
+                self.upload_replies.put_nowait(msg)
+                return
+        elif mtype == "file_error" and msg.get("id") in self.downloads:
+            self._download_error(msg)
+            return
+        if fut is None:
+            self.emit("server", msg)
+
+    def _catch_up(self, msg):
+        # since_id pages come oldest first; keep asking from the end of each page
+        # until the server has nothing newer, and drop anything that already
+        # arrived live in the meantime
+        live = self.catch_up or set()
+        ids = [m["id"] for m in msg.get("messages", ())]
+        if ids:
+            self.last_id = max(ids + [self.last_id or 0])
+        if msg.get("has_more") and ids:
+            self.send_queue.put_nowait(({"type": "history_after", "room": self.room, "since_id": max(ids)}, b""))
+        else:
+            self.last_id = max(list(live) + [self.last_id or 0])
+            self.catch_up = None
+        return dict(msg, messages=[m for m in msg.get("messages", ()) if m["id"] not in live])
+
+    # -----------------------------------------------------------
+    # Uploads
+    # -----------------------------------------------------------
+    async def _upload(self, path):
+        filename = os.path.basename(path)
+        if self.upload_replies is not None:
+            self.emit("upload_failed", {"filename": filename, "reason": "another upload is running"})
+            return False
+        replies = self.upload_replies = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        try:
+            size = os.path.getsize(path)
+            self.emit("upload_progress", {"filename": filename, "stage": "hashing", "percent": 0})
+            digest = await loop.run_in_executor(None, file_sha256, path)
+            self.send({"type": "upload_start", "filename": filename, "size": size, "sha256": digest})
+            reply = await asyncio.wait_for(replies.get(), 60)
+            if reply.get("type") == "upload_done":
+                # the server already has this content; nothing to transfer
+                self.emit("upload_done", {"filename": filename, "file_id": reply.get("file_id"), "deduplicated": True})
+                return True
+            if reply.get("type") != "upload_ready":
+                raise RuntimeError(reply.get("reason", "upload refused"))
+            upload_id = reply["upload_id"]
+            offset = acked = reply["offset"]
+
+            started = time.monotonic()
+            resumed_from = offset
+            outstanding = 0
+            with open(path, "rb") as f:
+                while offset < size or outstanding:
+                    if offset < size and outstanding < UPLOAD_WINDOW:
+                        chunk = await loop.run_in_executor(None, read_at, f, offset, UPLOAD_CHUNK_SIZE)
+                        header = {"type": "upload_chunk", "upload_id": upload_id, "offset": offset,
+                                  "size": len(chunk), "sha256": hashlib.sha256(chunk).hexdigest()}
+                        self.send_queue.put_nowait((header, chunk))
+                        offset += len(chunk)
+                        outstanding += 1
+                        continue
+                    reply = await asyncio.wait_for(replies.get(), 120)
+                    outstanding -= 1
+                    acked = reply["offset"]
+                    if reply.get("reason") in ("unknown_upload", "disconnected"):
+                        raise RuntimeError(reply["reason"])
+                    if reply.get("type") == "upload_error":
+                        # let the rest of the window come back, then carry on from the server's offset
+                        while outstanding:
+                            acked = (await asyncio.wait_for(replies.get(), 120))["offset"]
+                            outstanding -= 1
+                        offset = acked
+                    elapsed = max(time.monotonic() - started, 0.001)
+                    self.emit("upload_progress", {"filename": filename, "stage": "sending",
+                                                  "percent": acked * 100 // max(size, 1),
+                                                  "mb_per_s": (acked - resumed_from) / elapsed / 1e6})
+
+            self.send({"type": "upload_finish", "upload_id": upload_id})
+            reply = await asyncio.wait_for(replies.get(), 300)
+            if reply.get("type") != "upload_done":
+                raise RuntimeError(reply.get("reason", "upload failed"))
+            self.emit("upload_done", {"filename": filename, "file_id": reply.get("file_id"), "deduplicated": False})
+            return True
+        except Exception as e:
+            self.emit("upload_failed", {"filename": filename, "reason": str(e) or type(e).__name__})
+            return False
+        finally:
+            self.upload_replies = None
+
+    # -----------------------------------------------------------
+    # Downloads
+    # -----------------------------------------------------------
+    async def _download(self, file_id, path, filename):
+        if file_id in self.downloads:
+            return
+        # bytes from an interrupted attempt are kept in <path>.part and resumed
+        part = path + ".part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        self.downloads[file_id] = {"path": path, "part": part, "filename": filename}
+        self.send({"type": "file_get", "id": file_id, "range": f"bytes={offset}-"})
+
+    async def _receive_download(self, reader, msg):
+        # the raw bytes follow the header on the socket and must be consumed here
+        loop = asyncio.get_running_loop()
+        dl = self.downloads.get(msg["id"])
+        remaining = msg["length"]
+        received = msg["offset"]
+        out = await loop.run_in_executor(None, open_part, dl["part"], msg["offset"]) if dl else None
+        try:
+            last_report = 0
+            while remaining > 0:
+                chunk = await reader.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("connection closed during download")
+                if out:
+                    await loop.run_in_executor(None, out.write, chunk)
+                remaining -= len(chunk)
+                received += len(chunk)
+                if dl and received - last_report >= 1024 * 1024:
+                    last_report = received
+                    self.emit("download_progress", {"id": msg["id"], "filename": dl["filename"],
+                                                    "percent": received * 100 // max(msg["size"], 1)})
+        finally:
+            if out:
+                await loop.run_in_executor(None, out.close)
+        if dl:
+            self._finish_download(msg["id"])
+
+    def _finish_download(self, file_id):
+        dl = self.downloads.pop(file_id)
+        os.replace(dl["part"], dl["path"])
+        self.emit("download_done", {"id": file_id, "filename": dl["filename"], "path": dl["path"]})
+
+    def _download_error(self, msg):
+        dl = self.downloads[msg["id"]]
+        if msg.get("reason") == "bad_range" and os.path.exists(dl["part"]) \
+                and os.path.getsize(dl["part"]) == msg.get("size"):
+            # everything was already downloaded last time
+            self._finish_download(msg["id"])
+            return
+        self.downloads.pop(msg["id"])
+        self.emit("download_failed", {"id": msg["id"], "filename": dl["filename"], "reason": msg.get("reason")})
+
+
+# ============================================================
+#                     FILE HELPERS
+# ============================================================
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_at(f, pos, n):
+    f.seek(pos)
+    return f.read(n)
+
+
+def open_part(path, offset):
+    f = open(path, "r+b" if os.path.exists(path) else "wb")
+    f.seek(offset)
+    f.truncate()
+    return f
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import struct
+import zlib
+
+try:
+    import msgpack  #type: ignore
+except ImportError:
+    msgpack = None
+
+# Wire formats shared by server1.py, chat_engine.py and chat_bench.py.
+#
+# Every connection starts in line-JSON mode (one JSON object per line). A client
+# may send {"type": "hello", "codecs": [...], "compress": ["zlib"]} as its first
+# frame; the server answers with a line-JSON hello_response naming the codec it
+# picked, and from the next frame on both sides use length-prefixed binary
+# frames: a 4-byte big-endian length whose top bit marks a zlib-compressed
+# payload, followed by the payload. Raw upload/download bytes still follow their
+# header frame unframed, exactly as in line mode.
+
+COMPRESS_MIN = 512            # payloads smaller than this are never compressed
+COMPRESS_LEVEL = 1            # zlib level; 1 gets most of the gain for little CPU
+FRAME_MAX = 16 * 1024 * 1024  # largest binary payload accepted (after decompression too)
+
+HEADER = struct.Struct('>I')
+COMPRESSED = 0x80000000
+
+class FrameError(Exception):
+    # the stream can no longer be split into frames; the connection must go
+    pass
+
+class LineJSON:
+    name = 'json'
+    label = 'line'
+    binary = False
+    compress = False
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b"\n"
+
+    async def read(self, reader, limit=FRAME_MAX):
+        # returns (message or None at EOF, bytes consumed); ValueError if undecodable.
+        # Line length is capped by the StreamReader's own limit, not by `limit`.
+        try:
+            line = await reader.readline()
+        except ValueError as e:
+            # over the reader's limit: readline has thrown away part of the line
+            raise FrameError(str(e))
+        if not line:
+            return None, 0
+        return json.loads(line.decode('utf-8')), len(line)
+
+class BinaryCodec:
+    binary = True
+
+    def __init__(self, name, compress):
+        self.name = name
+        self.compress = compress
+        self.label = name + ('+zlib' if compress else '')
+
+    def dumps(self, obj):
+        if self.name == 'msgpack':
+            return msgpack.packb(obj, use_bin_type=True)
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, payload):
+        if self.name == 'msgpack':
+            try:
+                return msgpack.unpackb(payload, raw=False)
+            except Exception as e:
+                raise ValueError(f'bad msgpack payload: {e}')
+        return json.loads(payload.decode('utf-8'))
+
+    def encode(self, obj):
+        payload = self.dumps(obj)
+        flag = 0
+        if self.compress and len(payload) >= COMPRESS_MIN:
+            packed = zlib.compress(payload, COMPRESS_LEVEL)
+            if len(packed) < len(payload):
+                payload, flag = packed, COMPRESSED
+        return HEADER.pack(len(payload) | flag) + payload
+
+    async def read(self, reader, limit=FRAME_MAX):
+        try:
+            head = await reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None, 0
+            raise
+        (length,) = HEADER.unpack(head)
+        compressed = length & COMPRESSED
+        length &= ~COMPRESSED
+        if length > limit:
+            raise FrameError(f'frame of {length} bytes is over the limit')
+        payload = await reader.readexactly(length)
+        if compressed:
+            z = zlib.decompressobj()
+            try:
+                data = z.decompress(payload, limit)
+            except zlib.error as e:
+                raise ValueError(f'bad compressed payload: {e}')
+            if z.unconsumed_tail:
+                raise FrameError('compressed frame expands past the limit')
+            payload = data
+        return self.loads(payload), HEADER.size + length
+
+LINE_JSON = LineJSON()
+_codecs = {}
+
+def get_codec(name, compress=False):
+    # one instance per variant so broadcasts can share an encoded frame per codec
+    key = (name, bool(compress))
+    if key not in _codecs:
+        _codecs[key] = BinaryCodec(name, bool(compress))
+    return _codecs[key]
+
+def supported_codecs():
+    return ['msgpack', 'json'] if msgpack is not None else ['json']
+
+def hello_request(compress=True):
+    return {'type': 'hello', 'codecs': supported_codecs(), 'compress': ['zlib'] if compress else []}
+
+def negotiate(msg):
+    # server side: pick the first codec in the client's preference list we can speak
+    offered = msg.get('codecs')
+    if not isinstance(offered, list):
+        return None
+    for name in offered:
+        if name in supported_codecs():
+            return get_codec(name, 'zlib' in (msg.get('compress') or ()))
+    return None
+
+def codec_from_response(msg):
+    # client side: the codec the server chose, or None to stay on line JSON
+    if msg.get('type') != 'hello_response' or not msg.get('ok') or msg.get('codec') not in supported_codecs():
+        return None
+    return get_codec(msg['codec'], msg.get('compress'))
@@ -0,0 +1,415 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import itertools
+import json
+import sys
+import time
+from datetime import datetime
+
+from chat_bench import DEFAULT_HOST, DEFAULT_PORT, READ_LIMIT, process_cpu_seconds, spawn_server, summarize
+from chat_protocol import LINE_JSON, codec_from_response
+
+# Plays a capture recorded by `server1.py --capture` back against a server,
+# one connection per captured connection, at the captured pace (--speed 1),
+# N times faster, or as fast as the server answers (--speed max). Every frame
+# gets a fresh rid so replies can be timed per request type; messages are
+# timed until the sender sees its own broadcast. Frames a real client only
+# sends after a reply (anything after login, upload chunks after upload_ready)
+# wait for that reply, so a slow server slows the replay down like it would
+# slow down its clients.
+
+REPLAY_PASSWORD = 'replay-password'
+REPLY_TIMEOUT = 30          # seconds to wait for a reply the replay itself depends on
+DRAIN_TIMEOUT = 30          # seconds a finished connection waits for outstanding replies
+MARKER = 'replay|'
+DONE_TYPES = {'join': 'history'}  # requests timed to a later reply than the first one
+WAIT_TYPES = ('register', 'login', 'upload_start', 'file_meta')  # the next frame waits for their reply
+
+# --- Capture files ---
+def load_capture(paths):
+    # merge capture files (one per --workers process) into
+    # {(file index, connection): [(ms, frame or None), ...]} on one timeline
+    files = []
+    for path in paths:
+        records = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('capture') != 1:
+                raise SystemExit(f'{path}: not a capture file')
+            try:
+                for line in f:
+                    records.append(json.loads(line))
+            except (EOFError, json.JSONDecodeError):
+                pass  # the server was killed mid-write; keep what is complete
+        files.append((datetime.fromisoformat(header['started_at']), records))
+    first = min(started for started, _ in files)
+    conns = {}
+    for n, (started, records) in enumerate(files):
+        offset = (started - first).total_seconds() * 1000
+        for t, conn, frame in records:
+            conns.setdefault((n, conn), []).append((t + offset, frame))
+    return conns
+
+def capture_users(conns):
+    # every user the capture names; the replay creates them all up front, since
+    # connections run on their own clocks and a login can overtake the register
+    # it depended on live. Captured registers go to throwaway names instead.
+    names = set()
+    for frames in conns.values():
+        for _, frame in frames:
+            if frame and isinstance(frame.get('username'), str):
+                if frame.get('type') in ('login', 'resume', 'register'):
+                    names.add(frame['username'])
+    return sorted(names)
+
+# --- Upload stand-ins ---
+def synthetic(seed, offset, size):
+    # bytes for an upload we only know the size of: a 32-byte pattern derived
+    # from the original hash, so files that were equal stay equal (and dedupe)
+    block = hashlib.sha256(str(seed).encode('utf-8')).digest()
+    start = offset % len(block)
+    return (block * ((start + size) // len(block) + 1))[start:start + size]
+
+def synthetic_sha256(seed, size):
+    h = hashlib.sha256()
+    step = 1024 * 1024
+    for offset in range(0, size, step):
+        h.update(synthetic(seed, offset, min(step, size - offset)))
+    return h.hexdigest()
+
+# --- Replayed connection ---
+class ReplayConn:
+    def __init__(self, replay, index, frames):
+        self.replay = replay
+        self.index = index
+        self.frames = frames
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.codec = LINE_JSON
+        self.rid = 0
+        self.pending = {}       # rid -> (request type, sent at)
+        self.waiters = {}       # rid -> future, for replies the replay has to act on
+        self.hello = None
+        self.new_uploads = []   # (live upload_id, seed) in upload_start order, not yet matched
+        self.upload_ids = {}    # captured upload_id -> (live upload_id, seed)
+        self.marker = f'{MARKER}{index}|'
+
+    async def run(self, start, speed):
+        try:
+            for t, frame in self.frames:
+                if speed:
+                    delay = start + t / 1000 / speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if frame is None:
+                    break
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.open_connection(
+                        self.replay.host, self.replay.port, limit=READ_LIMIT)
+                    self.listener = asyncio.create_task(self.listen())
+                await self.send_frame(dict(frame))
+            deadline = time.perf_counter() + DRAIN_TIMEOUT
+            while self.pending and time.perf_counter() < deadline:
+                await asyncio.sleep(0.05)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self.replay.failed_connections += 1
+            print(f'connection {self.index}: {e or type(e).__name__}')
+        finally:
+            self.replay.unanswered += len(self.pending)
+            if self.listener:
+                self.listener.cancel()
+            if self.writer:
+                self.writer.close()
+
+    async def send_frame(self, frame):
+        loop = asyncio.get_running_loop()
+        mtype = frame.get('type')
+        raw = b''
+        seed = None
+        if mtype == 'hello':
+            self.hello = loop.create_future()
+            t0 = time.perf_counter()
+            await self.write(LINE_JSON.encode(frame), frames=1)
+            await self.wait(self.hello, mtype)
+            self.replay.record(mtype, time.perf_counter() - t0, False)
+            return
+        if mtype == 'resume':
+            # tokens are not captured; log the same user in instead
+            if not frame.get('username'):
+                self.replay.skipped += 1
+                return
+            frame = {'type': 'login', 'username': frame['username']}
+            mtype = 'login'
+        if mtype == 'register':
+            # same bcrypt work and reply as live, without racing the real user
+            frame['username'] = f"{frame.get('username')}~{self.replay.run_tag}.{next(self.replay.fresh_names)}"
+        if mtype in ('login', 'register'):
+            frame['password'] = self.replay.password
+        elif mtype == 'upload_start':
+            seed = frame.get('sha256')
+            size = int(frame.get('size') or 0)
+            frame['sha256'] = await loop.run_in_executor(None, synthetic_sha256, seed, size)
+        elif mtype == 'upload_chunk':
+            live = self.live_upload(frame.get('upload_id'))
+            if live is None:
+                self.replay.skipped += 1
+                return
+            frame['upload_id'], seed = live
+            raw = synthetic(seed, int(frame.get('offset') or 0), int(frame.get('size') or 0))
+            frame['sha256'] = hashlib.sha256(raw).hexdigest()
+        self.rid += 1
+        rid = frame['rid'] = self.rid
+        if mtype == 'message':
+            text = str(frame.get('text') or '')
+            tag = f'{self.marker}{rid}|'
+            frame['text'] = tag + text[len(tag):]
+        fut = None
+        if mtype in WAIT_TYPES:
+            fut = self.waiters[rid] = loop.create_future()
+        self.pending[rid] = (mtype, time.perf_counter())
+        await self.write(self.codec.encode(frame) + raw, frames=1)
+        if fut is None:
+            return
+        reply = await self.wait(fut, mtype)
+        if reply is None:
+            return
+        if mtype == 'upload_start' and reply.get('type') == 'upload_ready':
+            self.new_uploads.append((reply['upload_id'], seed))
+        elif mtype == 'file_meta' and reply.get('type') == 'file_ready':
+            meta = frame.get('meta') or {}
+            size = int(meta.get('size') or 0)
+            seed = f"{meta.get('filename')}|{size}"
+            step = 1024 * 1024
+            for offset in range(0, size, step):
+                await self.write(synthetic(seed, offset, min(step, size - offset)))
+
+    def live_upload(self, captured_id):
+        # captured upload ids are matched to live ones in upload_start order
+        if captured_id not in self.upload_ids:
+            if not self.new_uploads:
+                return None
+            self.upload_ids[captured_id] = self.new_uploads.pop(0)
+        return self.upload_ids[captured_id]
+
+    async def wait(self, fut, mtype):
+        try:
+            return await asyncio.wait_for(fut, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.replay.timeouts[mtype] = self.replay.timeouts.get(mtype, 0) + 1
+            return None
+
+    async def write(self, data, frames=0):
+        self.replay.bytes_out += len(data)
+        self.replay.frames_out += frames
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def listen(self):
+        try:
+            while True:
+                msg, size = await self.codec.read(self.reader)
+                if msg is None:
+                    break
+                now = time.perf_counter()
+                self.replay.bytes_in += size
+                mtype = msg.get('type')
+                if mtype == 'hello_response':
+                    # everything after it uses the negotiated framing
+                    self.codec = codec_from_response(msg) or LINE_JSON
+                    if self.hello is not None and not self.hello.done():
+                        self.hello.set_result(msg)
+                    continue
+                rid = msg.get('rid')
+                if mtype == 'message' and str(msg.get('text', '')).startswith(self.marker):
+                    rid = int(msg['text'][len(self.marker):].split('|', 1)[0])
+                if rid not in self.pending:
+                    continue
+                request_type, sent_at = self.pending[rid]
+                failed = mtype == 'error' or msg.get('ok') is False or str(mtype).endswith('_error')
+                if failed or DONE_TYPES.get(request_type, mtype) == mtype:
+                    del self.pending[rid]
+                    self.replay.record(request_type, now - sent_at, failed)
+                fut = self.waiters.pop(rid, None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+# --- Replay driver ---
+class Replay:
+    def __init__(self, args, conns):
+        self.args = args
+        self.host = args.host
+        self.port = args.port
+        self.password = args.password
+        self.conns = conns
+        self.latencies = {}     # request type -> seconds
+        self.errors = {}
+        self.timeouts = {}
+        self.skipped = 0
+        self.unanswered = 0
+        self.failed_connections = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.server_pid = None
+        self.run_tag = f'{time.time():.0f}'  # keeps throwaway register names unique across runs
+        self.fresh_names = itertools.count(1)
+
+    def record(self, mtype, seconds, failed):
+        self.latencies.setdefault(mtype, []).append(seconds)
+        if failed:
+            self.errors[mtype] = self.errors.get(mtype, 0) + 1
+
+    async def create_users(self, names):
+        # register every captured user with the replay password; bcrypt makes
+        # this slow, so it happens before the clock starts
+        sem = asyncio.Semaphore(4)
+
+        async def create(name):
+            async with sem:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=READ_LIMIT)
+                try:
+                    for _ in range(20):
+                        writer.write(LINE_JSON.encode({'type': 'register', 'username': name, 'password': self.password}))
+                        await writer.drain()
+                        reply, _ = await LINE_JSON.read(reader)
+                        if not reply or reply.get('reason') != 'busy_retry':
+                            break
+                        await asyncio.sleep(0.5)
+                finally:
+                    writer.close()
+        await asyncio.gather(*(create(name) for name in names))
+
+    async def run(self):
+        args = self.args
+        t0 = time.perf_counter()
+        names = capture_users(self.conns)
+        if not args.skip_setup:
+            await self.create_users(names)
+            print(f'{len(names)} users registered in {time.perf_counter() - t0:.1f}s')
+        speed = None if args.speed == 'max' else float(args.speed)
+        replayed = [ReplayConn(self, i, frames) for i, frames in enumerate(self.conns.values())]
+        captured_seconds = max((frames[-1][0] for frames in self.conns.values() if frames), default=0) / 1000
+        server_cpu_start = process_cpu_seconds(self.server_pid)
+        start = time.perf_counter()
+        await asyncio.gather(*(c.run(start, speed) for c in replayed))
+        elapsed = time.perf_counter() - start
+        server_cpu_end = process_cpu_seconds(self.server_pid)
+        types = {}
+        for mtype, samples in sorted(self.latencies.items()):
+            types[mtype] = dict(summarize(samples), errors=self.errors.get(mtype, 0),
+                                timeouts=self.timeouts.get(mtype, 0), per_s=len(samples) / elapsed)
+        return {
+            'config': {'captures': args.captures, 'speed': args.speed},
+            'started_at': datetime.utcnow().isoformat(),
+            'connections': len(replayed),
+            'captured_seconds': captured_seconds,
+            'elapsed_seconds': elapsed,
+            'frames_sent': self.frames_out,
+            'frames_per_s': self.frames_out / elapsed if elapsed else None,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'skipped': self.skipped,
+            'unanswered': self.unanswered,
+            'failed_connections': self.failed_connections,
+            'server_cpu_seconds': server_cpu_end - server_cpu_start if server_cpu_end is not None else None,
+            'types': types,
+        }
+
+# --- Baseline comparison ---
+def regressions(result, baseline, threshold, min_ms):
+    # a stat regresses when it is both `threshold` (relative) and `min_ms`
+    # (absolute) worse, so sub-millisecond noise does not fail a run
+    found = []
+    for mtype, cur in result['types'].items():
+        base = baseline.get('types', {}).get(mtype)
+        if not base or not base.get('count') or not cur['count']:
+            continue
+        for stat in ('p50_ms', 'p99_ms'):
+            if cur[stat] > base[stat] * (1 + threshold) and cur[stat] - base[stat] > min_ms:
+                found.append(f'{mtype} {stat}: {base[stat]:.2f} -> {cur[stat]:.2f} ms')
+        if cur['errors'] > base.get('errors', 0) and cur['errors'] > cur['count'] * threshold:
+            found.append(f"{mtype} errors: {base.get('errors', 0)} -> {cur['errors']}")
+    # throughput only means something when neither run waited on the capture's clock
+    if result['config']['speed'] == 'max' and baseline.get('config', {}).get('speed') == 'max':
+        if result['frames_per_s'] < baseline['frames_per_s'] * (1 - threshold):
+            found.append(f"throughput: {baseline['frames_per_s']:.0f} -> {result['frames_per_s']:.0f} frames/s")
+    return found
+
+def print_report(result, baseline=None):
+    print(f"{result['connections']} connections, {result['frames_sent']} frames in {result['elapsed_seconds']:.1f}s "
+          f"({result['frames_per_s']:.0f}/s; captured over {result['captured_seconds']:.1f}s)")
+    if result['skipped'] or result['unanswered'] or result['failed_connections']:
+        print(f"  skipped {result['skipped']}, unanswered {result['unanswered']}, "
+              f"failed connections {result['failed_connections']}")
+    print(f"  {'type':<16}{'count':>8}{'p50_ms':>10}{'p99_ms':>10}{'errors':>8}")
+    for mtype, cur in result['types'].items():
+        text = f"  {mtype:<16}{cur['count']:>8}{cur['p50_ms']:>10.2f}{cur['p99_ms']:>10.2f}{cur['errors']:>8}"
+        base = (baseline or {}).get('types', {}).get(mtype)
+        if base and base.get('p50_ms'):
+            text += (f"   (baseline p50 {base['p50_ms']:.2f} {(cur['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100:+.1f}%,"
+                     f" p99 {base['p99_ms']:.2f} {(cur['p99_ms'] - base['p99_ms']) / base['p99_ms'] * 100:+.1f}%)")
+        print(text)
+    if result['server_cpu_seconds'] is not None:
+        print(f"  server cpu            {result['server_cpu_seconds']:10.2f} s")
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description='Replay a server1.py --capture file against a chat server')
+    p.add_argument('captures', nargs='+', help='capture file(s); pass every worker file of a --workers capture')
+    p.add_argument('--host', default=DEFAULT_HOST)
+    p.add_argument('--port', type=int, default=DEFAULT_PORT)
+    p.add_argument('--speed', default='1', help="time scale: 1 for the captured pace, N for N times faster, or 'max'")
+    p.add_argument('--password', default=REPLAY_PASSWORD, help='password every captured user is given')
+    p.add_argument('--skip-setup', action='store_true', help='the users already exist with --password')
+    p.add_argument('--spawn-server', action='store_true', help='start a fresh server1.py in a temp dir for the replay')
+    p.add_argument('--out', help='write the results as JSON to this file')
+    p.add_argument('--baseline', help='compare against a previous --out file and exit 1 on a regression')
+    p.add_argument('--threshold', type=float, default=0.25, help='relative slowdown that counts as a regression')
+    p.add_argument('--min-ms', type=float, default=1.0, help='absolute slowdown below which latency changes are ignored')
+    args = p.parse_args(argv)
+    if args.speed != 'max':
+        try:
+            if float(args.speed) <= 0:
+                raise ValueError
+        except ValueError:
+            p.error("--speed must be a positive number or 'max'")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    conns = load_capture(args.captures)
+    if not conns:
+        raise SystemExit('capture is empty')
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    replay = Replay(args, conns)
+    proc = spawn_server(args.port) if args.spawn_server else None
+    if proc:
+        replay.server_pid = proc.pid
+    try:
+        result = asyncio.run(replay.run())
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+    print_report(result, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+    if baseline:
+        if baseline.get('config', {}).get('speed') != args.speed:
+            print(f"note: baseline ran at --speed {baseline.get('config', {}).get('speed')}, this run at {args.speed}")
+        found = regressions(result, baseline, args.threshold, args.min_ms)
+        for line in found:
+            print('REGRESSION', line)
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,27 @@
-import socket
-import ssl
-import threading
-import json
+import argparse
+import queue
+from collections import deque
 import tkinter as tk
 from tkinter import simpledialog, filedialog, messagebox
 from tkinter.scrolledtext import ScrolledText
-import os
 from datetime import datetime
 from plyer import notification   #type: ignore
+import chat_engine
+from chat_config import ConfigError, apply_settings, format_settings, parse_assignments, settings_of
+from chat_engine import ChatEngine
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 8765
 USE_TLS = False
-CHUNK_SIZE = 64 * 1024
+POLL_MS = 50             # how often the UI drains engine events
+EVENTS_PER_POLL = 200    # cap per tick so a burst cannot freeze the window
+SCROLLBACK_BUBBLES = 500 # bubbles kept rendered in the chat display
+SCROLLBACK_KEEP = 5000   # older bubbles held off-screen for scrolling back
+LAZY_PAGE = 50           # older bubbles rendered each time the view hits the top
+
+# these and chat_engine's constants can be set from client_config.json,
+# CHAT_<NAME> environment variables or --set NAME=VALUE (see chat_config.py)
+SETTINGS = settings_of(globals())
 
 
 # ============================================================
@@ -48,14 +57,26 @@ class ChatClientGUI:
 
         self.theme = self.light_theme
 
-        self.sock = None
-        self.reader = None
-        self.writer = None
+        # all networking lives in the engine's thread; we only see its event queue
+        self.engine = ChatEngine(SERVER_HOST, SERVER_PORT, USE_TLS,
+                                 protocol=chat_engine.PROTOCOL, compress=chat_engine.COMPRESS)
+        self.engine.start()
         self.username = None
         self.current_room = None
+        self.uploading = False
+
+        # chat display model: only `rendered` is in the Text widget
+        self.pending = []                              # bubbles waiting for the next flush
+        self.rendered = deque()                        # (bubble, line count) currently shown
+        self.older = deque(maxlen=SCROLLBACK_KEEP)     # trimmed or not yet shown, oldest first
+        self.flush_scheduled = False
+        self.links = {}                                # file id -> filename for Download links
+        self.has_more = False                          # server has messages older than any we hold
+        self.loading_older = False                     # a history_before request is in flight
 
         self.build_ui()
         self.apply_theme()
+        self.root.after(POLL_MS, self.poll_events)
 
     # -----------------------------------------------------------
     # UI Construction
@@ -77,12 +98,16 @@ class ChatClientGUI:
         self.rooms_btn = tk.Button(top, text="Rooms", command=self.list_rooms, width=10)
         self.rooms_btn.pack(side='left', padx=5)
 
+        self.search_btn = tk.Button(top, text="Search", command=self.search, width=10)
+        self.search_btn.pack(side='left', padx=5)
+
         self.theme_btn = tk.Button(top, text="Toggle Theme", command=self.toggle_theme, width=12)
         self.theme_btn.pack(side='left', padx=5)
 
         # chat display
         self.display = ScrolledText(self.root, state='disabled', font=("Segoe UI", 11), wrap="word")
         self.display.pack(fill='both', expand=True, padx=10, pady=10)
+        self.display.configure(yscrollcommand=self.on_display_scroll)
 
         bottom = tk.Frame(self.root)
         bottom.pack(fill='x')
@@ -107,6 +132,10 @@ class ChatClientGUI:
         self.display.tag_configure("bubble_other", background=self.theme["bubble_other"],
                                    foreground=self.theme["text_color"],
                                    lmargin1=10, lmargin2=10, rmargin=50, spacing3=5, wrap="word")
+        self.display.tag_configure("link", underline=True, foreground="#1565c0")
+        self.display.tag_bind("link", "<Button-1>", self.on_link_click)
+        self.display.tag_bind("link", "<Enter>", lambda e: self.display.configure(cursor="hand2"))
+        self.display.tag_bind("link", "<Leave>", lambda e: self.display.configure(cursor=""))
 
     # -----------------------------------------------------------
     # Theme Handling
@@ -128,7 +157,7 @@ class ChatClientGUI:
         self.display.tag_configure("bubble_other", background=t["bubble_other"], foreground=t["text_color"])
 
         # buttons
-        for btn in [self.login_btn, self.join_btn, self.rooms_btn, self.theme_btn,
+        for btn in [self.login_btn, self.join_btn, self.rooms_btn, self.search_btn, self.theme_btn,
                     self.send_btn, self.file_btn]:
             btn.configure(bg=t["btn_bg"], fg=t["btn_fg"], activebackground="#dddddd")
 
@@ -140,23 +169,60 @@ class ChatClientGUI:
     # Networking
     # -----------------------------------------------------------
     def connect_socket(self):
-        if self.sock:
+        if self.engine.connected:
             return True
+        # runs on the engine loop; a short wait keeps the login dialog flow simple
         try:
-            raw = socket.create_connection((SERVER_HOST, SERVER_PORT))
-            if USE_TLS:
-                ctx = ssl.create_default_context()
-                self.sock = ctx.wrap_socket(raw, server_hostname=SERVER_HOST)
-            else:
-                self.sock = raw
-            self.reader = self.sock.makefile("rb")
-            self.writer = self.sock
-            threading.Thread(target=self.listen_loop, daemon=True).start()
-            self.status.configure(text="Connected")
-            return True
+            ok = self.engine.connect().result(timeout=10)
         except Exception as e:
             messagebox.showerror("Connection failed", str(e))
             return False
+        if ok:
+            self.status.configure(text="Connected")
+        return ok
+
+    def poll_events(self):
+        # drain engine events in batches on the Tk thread
+        try:
+            for _ in range(EVENTS_PER_POLL):
+                kind, payload = self.engine.events.get_nowait()
+                try:
+                    self.handle_event(kind, payload)
+                except Exception:
+                    pass
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self.poll_events)
+
+    def handle_event(self, kind, payload):
+        if kind == "server":
+            self.handle_server_message(payload)
+        elif kind == "error":
+            messagebox.showerror("Connection", payload)
+        elif kind == "disconnected":
+            self.status.configure(text=f"Disconnected ({payload}), reconnecting...")
+        elif kind == "reconnected":
+            self.status.configure(text=f"Logged in as {self.username}")
+        elif kind == "upload_progress":
+            if payload["stage"] == "hashing":
+                self.status.configure(text=f"Checking {payload['filename']}...")
+            else:
+                self.status.configure(text=f"Uploading {payload['filename']}: {payload['percent']}% "
+                                           f"({payload['mb_per_s']:.1f} MB/s)")
+        elif kind == "upload_done":
+            self.uploading = False
+            self.add_bubble("You", f"Sent file: {payload['filename']}", mine=True)
+            self.status.configure(text=f"Logged in as {self.username}")
+        elif kind == "upload_failed":
+            self.uploading = False
+            self.status.configure(text=f"Upload of {payload['filename']} interrupted; send it again to resume")
+            messagebox.showerror("File send failed", payload["reason"])
+        elif kind == "download_progress":
+            self.status.configure(text=f"Downloading {payload['filename']}: {payload['percent']}%")
+        elif kind == "download_done":
+            self.status.configure(text=f"Saved {payload['filename']}")
+        elif kind == "download_failed":
+            self.status.configure(text=f"Download failed: {payload['reason']}")
 
     # -----------------------------------------------------------
     # Notifications
@@ -170,18 +236,119 @@ class ChatClientGUI:
     # -----------------------------------------------------------
     # Message Bubble
     # -----------------------------------------------------------
-    def add_bubble(self, sender, text, mine=False):
-        timestamp = datetime.now().strftime("%H:%M")
+    def add_bubble(self, sender, text, mine=False, file_id=None, filename=None, msg_id=None):
+        self.queue_bubbles([self.make_bubble(sender, text, mine, file_id, filename, msg_id)])
+
+    def queue_bubbles(self, bubbles):
+        # drawn once per UI tick by flush_bubbles
+        self.pending.extend(bubbles)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.root.after_idle(self.flush_bubbles)
+
+    def make_bubble(self, sender, text, mine=False, file_id=None, filename=None, msg_id=None):
+        if file_id is not None:
+            self.links[file_id] = filename
+        return {"id": msg_id, "sender": sender, "text": text, "mine": mine, "file_id": file_id,
+                "time": datetime.now().strftime("%H:%M")}
+
+    def bubble_args(self, bubbles):
+        # flatten bubbles into one Text.insert(chars, tags, chars, tags, ...) call
+        args, lines = [], []
+        for b in bubbles:
+            tag = "bubble_me" if b["mine"] else "bubble_other"
+            body = f"{b['sender']}  ({b['time']})\n{b['text']}\n"
+            args += [body, tag]
+            if b["file_id"] is not None:
+                args += ["Download\n", (tag, "link", f"file_{b['file_id']}")]
+            args += ["\n", ()]
+            lines.append(body.count("\n") + (b["file_id"] is not None) + 1)
+        return args, lines
+
+    def flush_bubbles(self):
+        self.flush_scheduled = False
+        bubbles, self.pending = self.pending, []
+        if not bubbles:
+            return
+        following = self.display.yview()[1] >= 0.999
 
-        bubble_text = f"{sender}  ({timestamp})\n{text}\n"
+        args, lines = self.bubble_args(bubbles)
+        self.display.configure(state='normal')
+        self.display.insert("end", *args)
+        self.rendered.extend(zip(bubbles, lines))
+
+        # trim the top unless the user is reading back (then allow some slack)
+        limit = SCROLLBACK_BUBBLES if following else SCROLLBACK_BUBBLES * 2
+        drop = 0
+        while len(self.rendered) > limit:
+            bubble, n = self.rendered.popleft()
+            if len(self.older) == self.older.maxlen:
+                self.has_more = True   # the oldest stashed bubble falls off; refetch it later
+            self.older.append(bubble)
+            drop += n
+        if drop:
+            self.display.delete("1.0", f"{drop + 1}.0")
+        if following:
+            self.display.see("end")
+        self.display.configure(state='disabled')
 
+    def clear_display(self):
+        self.pending, self.rendered, self.older = [], deque(), deque(maxlen=SCROLLBACK_KEEP)
+        self.has_more = self.loading_older = False
         self.display.configure(state='normal')
-        tag = "bubble_me" if mine else "bubble_other"
-        self.display.insert("end", bubble_text, tag)
-        self.display.insert("end", "\n")
-        self.display.see("end")
+        self.display.delete("1.0", "end")
         self.display.configure(state='disabled')
 
+    def stash_older(self, bubbles):
+        # history that is not drawn until the user scrolls up to it
+        self.older.extend(bubbles)
+
+    def on_display_scroll(self, first, last):
+        self.display.vbar.set(first, last)
+        if float(first) <= 0.0 and (self.older or self.has_more):
+            self.root.after_idle(self.render_older)
+
+    def render_older(self):
+        if self.display.yview()[0] > 0.0:
+            return
+        if not self.older:
+            self.request_older()
+            return
+        page = []
+        while self.older and len(page) < LAZY_PAGE:
+            page.append(self.older.pop())
+        page.reverse()
+
+        args, lines = self.bubble_args(page)
+        self.display.configure(state='normal')
+        self.display.insert("1.0", *args)
+        self.display.configure(state='disabled')
+        self.rendered.extendleft(reversed(list(zip(page, lines))))
+        # keep the previously top bubble where it was
+        self.display.yview(f"{sum(lines) + 1}.0")
+
+    def request_older(self):
+        # everything held locally is drawn; page further back from the server
+        if not self.has_more or self.loading_older or not self.current_room:
+            return
+        before_id = next((b["id"] for b, _ in self.rendered if b["id"] is not None), None)
+        if before_id is None:
+            return
+        self.loading_older = True
+        self.send_json({"type": "history_before", "room": self.current_room,
+                        "before_id": before_id, "limit": LAZY_PAGE})
+
+    def history_bubbles(self, messages):
+        return [self.make_bubble(m["sender"], m["text"], m["sender"] == self.username, msg_id=m.get("id"))
+                for m in messages]
+
+    def on_link_click(self, event):
+        for tag in self.display.tag_names(f"@{event.x},{event.y}"):
+            if tag.startswith("file_"):
+                file_id = int(tag[5:])
+                self.download_file(file_id, self.links.get(file_id))
+                return
+
     # -----------------------------------------------------------
     # Login & User Actions
     # -----------------------------------------------------------
@@ -208,7 +375,7 @@ class ChatClientGUI:
             messagebox.showinfo("Not logged in", "Please login first")
             return
         room = self.room_entry.get().strip() or "main"
-        self.send_json({"type": "join", "room": room})
+        self.send_json({"type": "join", "room": room, "limit": LAZY_PAGE})
 
     def list_rooms(self):
         if not self.username:
@@ -216,6 +383,15 @@ class ChatClientGUI:
             return
         self.send_json({"type": "list_rooms"})
 
+    def search(self):
+        if not self.username:
+            messagebox.showinfo("Not logged in", "Login first")
+            return
+        query = simpledialog.askstring("Search", "Search messages in this room:")
+        if not query:
+            return
+        self.send_json({"type": "search", "query": query, "room": self.current_room})
+
     def send_message(self):
         text = self.entry.get().strip()
         if not text:
@@ -231,56 +407,29 @@ class ChatClientGUI:
         if not self.username:
             messagebox.showinfo("Not logged in", "Login first")
             return
+        if self.uploading:
+            messagebox.showinfo("Upload in progress", "Please wait for the current upload to finish")
+            return
 
         filepath = filedialog.askopenfilename()
         if not filepath:
             return
 
-        size = os.path.getsize(filepath)
-        filename = os.path.basename(filepath)
-        self.send_json({"type": "file_meta", "meta": {"filename": filename, "size": size}})
+        # hashing and sending happen on the engine thread; progress comes back as events
+        self.uploading = True
+        self.engine.upload(filepath)
 
-        try:
-            with open(filepath, "rb") as f:
-                while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    self.writer.sendall(chunk)
-
-            self.add_bubble("You", f"Sent file: {filename}", mine=True)
-        except Exception as e:
-            messagebox.showerror("File send failed", str(e))
+    def download_file(self, file_id, filename):
+        path = filedialog.asksaveasfilename(initialfile=filename)
+        if not path:
+            return
+        self.engine.download(file_id, path, filename)
 
     # -----------------------------------------------------------
     # JSON Send
     # -----------------------------------------------------------
     def send_json(self, obj):
-        try:
-            data = json.dumps(obj).encode("utf-8") + b"\n"
-            self.writer.sendall(data)
-        except Exception as e:
-            messagebox.showerror("Send error", str(e))
-
-    # -----------------------------------------------------------
-    # Server Listener
-    # -----------------------------------------------------------
-    def listen_loop(self):
-        try:
-            while True:
-                line = self.reader.readline()
-                if not line:
-                    break
-                try:
-                    msg = json.loads(line.decode("utf-8"))
-                    self.handle_server_message(msg)
-                except:
-                    continue
-        except:
-            pass
-        finally:
-            if self.sock:
-                self.sock.close()
+        self.engine.send(obj)
 
     # -----------------------------------------------------------
     # Server Message Processing
@@ -291,6 +440,8 @@ class ChatClientGUI:
         if mtype == "register_response":
             if msg.get("ok"):
                 messagebox.showinfo("Registered", "Registration successful.")
+            elif msg.get("reason") == "busy_retry":
+                messagebox.showwarning("Server busy", "Server is busy, please retry in a moment")
             else:
                 messagebox.showerror("Failed", "Registration failed")
 
@@ -299,17 +450,38 @@ class ChatClientGUI:
                 self.username = self.attempted_username
                 messagebox.showinfo("Login", "Login successful")
                 self.status.configure(text=f"Logged in as {self.username}")
+            elif msg.get("reason") == "busy_retry":
+                messagebox.showwarning("Server busy", "Server is busy, please retry in a moment")
             else:
                 messagebox.showerror("Login failed", "Bad credentials")
 
         elif mtype == "join_response":
-            room = msg.get("room")
-            self.current_room = room
-            self.add_bubble("System", f"Joined room: {room}")
+            # a new room starts a fresh view; history follows right after.
+            # A rejoin after reconnect (since_id) keeps what is on screen.
+            self.current_room = msg.get("room")
+            if msg.get("since_id") is None:
+                self.clear_display()
 
         elif mtype == "history":
-            for m in msg.get("messages", []):
-                self.add_bubble(m["sender"], m["text"])
+            bubbles = self.history_bubbles(msg.get("messages", []))
+            if msg.get("since_id") is not None:
+                # messages missed while disconnected, oldest first; the engine
+                # keeps asking for the next page until it has caught up
+                self.queue_bubbles(bubbles)
+                return
+            self.has_more = msg.get("has_more", False)
+            # only the newest page is drawn now; the rest waits for a scroll up
+            self.stash_older(bubbles[:-LAZY_PAGE])
+            self.queue_bubbles(bubbles[-LAZY_PAGE:])
+            self.add_bubble("System", f"Joined room: {msg.get('room')}")
+
+        elif mtype == "history_page":
+            if msg.get("room") != self.current_room:
+                return
+            self.loading_older = False
+            self.has_more = msg.get("has_more", False)
+            self.older.extendleft(reversed(self.history_bubbles(msg.get("messages", []))))
+            self.render_older()
 
         elif mtype == "message":
             sender = msg["sender"]
@@ -317,7 +489,7 @@ class ChatClientGUI:
             if sender == self.username:
                 return
 
-            self.add_bubble(sender, text, mine=False)
+            self.add_bubble(sender, text, mine=False, msg_id=msg.get("id"))
 
             if self.root.state() == "iconic":
                 self.notify(f"New message from {sender}", text)
@@ -328,11 +500,26 @@ class ChatClientGUI:
         elif mtype == "file_shared":
             sender = msg["sender"]
             filename = msg["filename"]
-            self.add_bubble(sender, f"Shared file: {filename}")
+            self.add_bubble(sender, f"Shared file: {filename}", file_id=msg.get("id"), filename=filename)
 
             if self.root.state() == "iconic":
                 self.notify("File received", f"{sender} shared {filename}")
 
+        elif mtype == "error":
+            if msg.get("reason") == "rate_limited":
+                self.status.configure(text=f"Slow down: try again in {msg.get('retry_after', 1):.0f}s")
+            else:
+                self.status.configure(text=f"Server error: {msg.get('reason')}")
+
+        elif mtype == "search_results":
+            results = msg.get("results", [])
+            lines = [f"[{r['room']}] {r['sender']}: {r['snippet']}" for r in results]
+            title = f"Search: {msg.get('query')}"
+            if lines or msg.get("archive"):
+                messagebox.showinfo(title, "\n".join(lines) or "No matches")
+            elif messagebox.askyesno(title, "No matches in recent messages. Search the archive too?"):
+                self.send_json({"type": "search", "query": msg.get("query"), "room": msg.get("room"), "archive": True})
+
         elif mtype == "rooms":
             messagebox.showinfo("Rooms", "\n".join(msg.get("rooms")))
 
@@ -341,8 +528,7 @@ class ChatClientGUI:
     # -----------------------------------------------------------
     def on_close(self):
         try:
-            if self.sock:
-                self.sock.close()
+            self.engine.stop()
         except:
             pass
         self.root.destroy()
@@ -352,7 +538,42 @@ class ChatClientGUI:
 #                     MAIN ENTRY
 # ============================================================
 
+def load_settings(path, required, overrides):
+    # one layer over both modules; names they share (SERVER_HOST, ...) stay in step
+    engine = vars(chat_engine)
+    names = SETTINGS + tuple(name for name in settings_of(engine) if name not in SETTINGS)
+    values = {name: globals()[name] if name in SETTINGS else engine[name] for name in names}
+    sources = apply_settings(values, names, path, required, overrides=overrides)
+    for name in sources:
+        if name in SETTINGS:
+            globals()[name] = values[name]
+        if name in engine:
+            engine[name] = values[name]
+    return values, names, sources
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--config", metavar="PATH",
+                        help="JSON file of settings (default: client_config.json when present)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override one setting, e.g. --set PROTOCOL=json (repeatable)")
+    parser.add_argument("--host", help="server address (SERVER_HOST)")
+    parser.add_argument("--port", type=int, help="server port (SERVER_PORT)")
+    parser.add_argument("--tls", action="store_true", default=None, help="connect with TLS (USE_TLS)")
+    args = parser.parse_args()
+    try:
+        overrides = parse_assignments(args.set)
+        for name, value in (("SERVER_HOST", args.host), ("SERVER_PORT", args.port), ("USE_TLS", args.tls)):
+            if value is not None:
+                overrides.append((name, value))
+        values, names, sources = load_settings(args.config or "client_config.json", args.config is not None, overrides)
+    except ConfigError as e:
+        parser.error(str(e))
+    print(f"Connecting to {SERVER_HOST}:{SERVER_PORT}" + (" over TLS" if USE_TLS else ""))
+    for line in format_settings(values, names, sources):
+        print(line)
+
     root = tk.Tk()
     app = ChatClientGUI(root)
     root.mainloop()
@@ -1,22 +1,126 @@
+import argparse
 import asyncio
+import contextvars
+import gzip
 import json
+import hashlib
 import sqlite3
 import os
 import ssl
+import signal
+import socket
+import sys
+import queue
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import bcrypt #type: ignore
-from cryptography.fernet import Fernet #type: ignore
-from datetime import datetime
+from cryptography.fernet import Fernet, InvalidToken #type: ignore
+from chat_config import ConfigError, apply_settings, dump_settings, format_settings, parse_assignments, settings_of
+from chat_protocol import LINE_JSON, FrameError, negotiate
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+try:
+    import uvloop  #type: ignore
+except ImportError:
+    uvloop = None
 
 DB_FILE = 'chat_server.db'
 HOST = '0.0.0.0'
 PORT = 8765
 TLS_CERT = 'cert.pem'
 TLS_KEY = 'key.pem'
+LISTEN_BACKLOG = 100                    # pending connections the kernel queues before accept (somaxconn caps it)
+EVENT_LOOP = 'auto'                     # auto (uvloop when installed) / uvloop / asyncio
+SOCKET_WRITE_BUFFER = None              # transport high-water mark in bytes; None keeps asyncio's 64 KiB
 CHUNK_SIZE = 64 * 1024
+FILES_DIR = 'uploads'                   # blobs and unfinished uploads
+AUTH_POOL = 'thread'      # 'thread' or 'process'
+AUTH_WORKERS = 4          # max logins hashing at once
+AUTH_QUEUE_SIZE = 64      # logins allowed to wait for a worker before we answer busy
+DB_BATCH_ROWS = 256       # commit once this many rows are queued...
+DB_BATCH_MS = 20          # ...or once the oldest queued row is this old
+DB_SYNCHRONOUS = 'NORMAL' # OFF / NORMAL / FULL (durability vs. commit cost)
+DB_READERS = 4                          # reader threads, each with a long-lived read-only connection
+DB_READ_CACHE_KB = 16 * 1024            # page cache per reader connection
+DB_MMAP_BYTES = 256 * 1024 * 1024       # memory-mapped I/O window per reader connection
+DB_STATEMENT_CACHE = 64                 # prepared statements kept per reader connection
+HISTORY_LIMIT = 100                     # messages cached per room (deepest join page)
+HISTORY_JOIN = 50                       # messages sent on join unless the client asks otherwise
+HISTORY_PAGE_MAX = 200                  # largest page a history_before request may ask for
+SEARCH_PAGE = 20                        # search results per page unless the client asks otherwise
+SEARCH_MAX_OFFSET = 1000                # deepest result a search may page to
+RETENTION_DAYS = None                   # messages and files older than this move to the archive; None keeps them
+RETENTION_MAX_MESSAGES = None           # newest messages kept per room in the live database; None for no cap
+RETENTION_ROOMS = {}                    # room -> (days, max_messages) overriding the two defaults above
+RETENTION_INTERVAL = 3600               # seconds between retention passes
+RETENTION_BATCH = 2000                  # rows archived per writer job, so inserts are never held up for long
+ARCHIVE_DIR = 'archive'                 # gzip JSONL partitions of retired rows, one per room per month
+VACUUM_PAGES = 1000                     # free pages handed back per incremental_vacuum step
+SESSION_KEY_FILE = 'session.key'        # Fernet key signing session tokens (created on first start)
+SESSION_TTL = 7 * 24 * 3600             # seconds a session token stays valid for resume
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024  # memory budget for cached room history
+OUTBOUND_MAX_BYTES = 1024 * 1024        # per-connection queue of frames not yet handed to the socket
+OUTBOUND_POLICY = 'drop_oldest'         # drop_oldest / disconnect / coalesce when a reader falls behind
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None       # e.g. 9100 to serve Prometheus metrics; None turns instrumentation off
+METRICS_MAX_ROOMS = 50    # per-room gauges are exported for the largest rooms only
+BUS_SOCKET = 'chat_bus.sock'  # Unix socket relaying room events between --workers processes
+BUS_ROOMS_INTERVAL = 0.5      # seconds between room-membership snapshots sent on the bus
+
+UPLOAD_MAX_CHUNK = 4 * 1024 * 1024      # largest upload_chunk payload accepted
+UPLOAD_PARTIAL_TTL = 24 * 3600          # seconds an unfinished upload is kept for resume
+UPLOAD_IDLE_CLOSE = 600                 # seconds before an idle upload's file handle is closed
+BLOB_GC_INTERVAL = 3600                 # seconds between sweeps of unreferenced blobs
+BLOB_GC_GRACE = 3600                    # seconds a blob stays after its last reference goes
+DOWNLOAD_CHUNK_SIZE = 256 * 1024        # read size when sendfile cannot be used (TLS)
+MAX_DOWNLOADS_PER_CONN = 2              # file_get streams queued/in flight per connection
+PIPELINE_MAX = 8                        # requests from one connection handled concurrently
+PIPELINE_DRAIN_TIMEOUT = 5.0            # seconds in-flight requests get to finish after a disconnect
+CLIENT_FRAME_MAX = 64 * 1024            # longest line / binary frame read from a client (raw upload bytes excluded)
+MAX_CONNS_PER_IP = 64                   # concurrent connections from one address; None for no cap
+CONN_LIMIT_EXEMPT = ('127.0.0.1', '::1')  # loopback (benchmarks, a local proxy) is not capped
+CONN_RETRY_AFTER = 5.0                  # retry hint sent with too_many_connections
+RATE_LIMITS = {                         # token buckets: action -> (burst, tokens per second); drop one to disable it
+    'message': (30, 5.0),               # per user
+    'room_message': (500, 200.0),       # per room, all senders together
+    'join': (10, 1.0),                  # per user
+    'upload': (5, 0.5),                 # per user, upload_start / file_meta
+}
+RATE_PAUSE_MAX = 5.0                    # longest a rate-limited connection goes unread
+RATE_SWEEP_INTERVAL = 60                # seconds between sweeps of refilled buckets
+CAPTURE_FILE = None                     # e.g. 'traffic.jsonl.gz' to record inbound frames for chat_replay.py
+CAPTURE_TEXT = False                    # keep message text and search queries in captures (else same-length filler)
+CAPTURE_FLUSH_INTERVAL = 1.0            # seconds between capture writes
+PROFILE = False                         # loop-stall stacks and the slow-request log (--profile)
+PROFILE_DIR = 'profiles'                # stall logs, slow_requests.jsonl and SIGUSR1 dumps
+LOOP_BLOCK_MS = 100                     # event loop blocked at least this long counts as a stall
+SLOW_REQUEST_MS = 250                   # requests slower than this are logged with per-phase timings
+PROFILE_SAMPLE_HZ = 100                 # stack samples per second for SIGUSR1 dumps
+PROFILE_SECONDS = 10                    # length of one SIGUSR1 sampling run
+
+# everything above can be set from server_config.json, CHAT_<NAME> or --set (see chat_config.py)
+SETTINGS = settings_of(globals())
+REPORT_SETTINGS = ('HOST', 'PORT', 'LISTEN_BACKLOG', 'CLIENT_FRAME_MAX', 'DB_FILE', 'DB_READERS',
+                   'AUTH_POOL', 'AUTH_WORKERS', 'HISTORY_LIMIT', 'OUTBOUND_MAX_BYTES', 'FILES_DIR')
+# types of the settings that default to None; config values must match (or be null)
+SETTING_TYPES = {'SOCKET_WRITE_BUFFER': int, 'RETENTION_DAYS': float, 'RETENTION_MAX_MESSAGES': int,
+                 'METRICS_PORT': int, 'CAPTURE_FILE': str}
+
+REQUEST_TYPES = frozenset(('hello', 'register', 'login', 'join', 'message', 'file_meta', 'list_rooms',
+                           'upload_start', 'upload_chunk', 'upload_finish', 'file_get', 'history_before',
+                           'history_after', 'search', 'resume'))
 
 # --- Database helpers ---
 def init_db():
     conn = sqlite3.connect(DB_FILE)
+    # only takes effect on a new database; --vacuum converts an existing one
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -28,36 +132,660 @@ def init_db():
             id INTEGER PRIMARY KEY, room TEXT, sender TEXT, text TEXT, ts DATETIME
         )
     ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id)')
     c.execute('''
         CREATE TABLE IF NOT EXISTS files (
             id INTEGER PRIMARY KEY, room TEXT, sender TEXT, filename TEXT, path TEXT, ts DATETIME
         )
     ''')
+    # content-addressed store: files rows are per-room metadata pointing at a shared blob
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY, path TEXT, size INTEGER, refcount INTEGER, created_at DATETIME, released_at DATETIME
+        )
+    ''')
+    # one row per archive partition so pagination can find older messages without opening files
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS archives (
+            room TEXT, month TEXT, path TEXT, min_id INTEGER, max_id INTEGER, rows INTEGER,
+            PRIMARY KEY (room, month)
+        )
+    ''')
+    # highest id ever handed out per table, so ids retention deleted are never reused
+    c.execute('CREATE TABLE IF NOT EXISTS id_floors (tbl TEXT PRIMARY KEY, last_id INTEGER)')
+    columns = [row[1] for row in c.execute('PRAGMA table_info(files)')]
+    if 'sha256' not in columns:
+        c.execute('ALTER TABLE files ADD COLUMN sha256 TEXT')
+        c.execute('ALTER TABLE files ADD COLUMN size INTEGER')
+    # full-text index over messages.text; rows are added by store_message
+    if not has_search_index(conn):
+        try:
+            c.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(text, room UNINDEXED, content='messages', content_rowid='id')")
+            if c.execute('SELECT 1 FROM messages LIMIT 1').fetchone():
+                print('Search index created empty; run with --rebuild-search to index existing messages')
+        except sqlite3.OperationalError as e:
+            print(f'Message search disabled: {e}')
+    if c.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        print('Incremental vacuum is off for this database; run with --vacuum once to enable it')
     conn.commit()
     conn.close()
 
+def vacuum_db():
+    init_db()
+    conn = sqlite3.connect(DB_FILE)
+    before = os.path.getsize(DB_FILE)
+    t0 = time.perf_counter()
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.close()
+    print(f'Vacuumed {before} -> {os.path.getsize(DB_FILE)} bytes in {time.perf_counter() - t0:.1f}s')
+
+def has_search_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone() is not None
+
+def rebuild_search_index():
+    init_db()
+    conn = sqlite3.connect(DB_FILE)
+    if not has_search_index(conn):
+        conn.close()
+        sys.exit('FTS5 is not available in this SQLite build')
+    t0 = time.perf_counter()
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+    conn.commit()
+    count = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    conn.close()
+    print(f'Indexed {count} messages in {time.perf_counter() - t0:.1f}s')
+
+# --- Metrics ---
+# Everything is recorded behind `if metrics.enabled`, so with METRICS_PORT unset
+# the hot path pays for one attribute check and nothing else.
+class Metrics:
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()  # the DB writer thread records too
+        self.counters = {}            # (name, labels) -> value
+        self.histograms = {}          # (name, labels) -> [bucket counts..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        req = current_request.get()
+        if req is not None and req.phases is not None:
+            # --profile: the same probes give slow requests their phase breakdown
+            phase = labels.get('op') or name[len('chat_'):-len('_seconds')]
+            req.phases[phase] = req.phases.get(phase, 0) + seconds
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0, 0]
+            h[bisect_left(self.BUCKETS, seconds)] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def type_label(self, mtype):
+        return mtype if mtype in REQUEST_TYPES else 'unknown'
+
+    def render(self, gauges):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f'# TYPE {name} counter')
+                seen.add(name)
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        for (name, labels), h in histograms:
+            if name not in seen:
+                lines.append(f'# TYPE {name} histogram')
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), h):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {h[-2]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {h[-1]}')
+        for name, labels, value in gauges:
+            if name not in seen:
+                lines.append(f'# TYPE {name} gauge')
+                seen.add(name)
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+metrics = Metrics()
+
+# --- Database writer ---
+# All inserts go through one long-lived connection on its own thread. Rows are
+# grouped into a single transaction per DB_BATCH_ROWS rows or DB_BATCH_MS ms, so
+# the event loop never waits for a commit/fsync.
+class DBWriter:
+    def __init__(self, path, batch_rows=DB_BATCH_ROWS, batch_ms=DB_BATCH_MS, synchronous=DB_SYNCHRONOUS):
+        if synchronous.upper() not in ('OFF', 'NORMAL', 'FULL'):
+            raise ValueError(f'invalid synchronous level: {synchronous}')
+        self.path = path
+        self.batch_rows = batch_rows
+        self.batch_ms = batch_ms
+        self.synchronous = synchronous.upper()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.next_ids = {}
+
+    def start(self, worker_id=0, workers=1):
+        # ids are handed out here rather than by SQLite so callers get them
+        # before the row is committed. With several worker processes each one
+        # takes every `workers`-th id so they never collide.
+        self.worker_id = worker_id
+        self.id_step = workers
+        conn = sqlite3.connect(self.path)
+        for table in ('messages', 'files'):
+            # the newest rows may have been archived away: never go below what was handed out
+            last = max(conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0],
+                       conn.execute('SELECT COALESCE(MAX(last_id), 0) FROM id_floors WHERE tbl=?', (table,)).fetchone()[0])
+            if table == 'messages':
+                # archived before id_floors existed
+                last = max(last, conn.execute('SELECT COALESCE(MAX(max_id), 0) FROM archives').fetchone()[0])
+            self.next_ids[table] = self._align(last + 1)
+        self.search = has_search_index(conn)
+        conn.close()
+        self.thread.start()
+
+    def _align(self, row_id):
+        return row_id + (self.worker_id - row_id) % self.id_step
+
+    def allocate_id(self, table):
+        row_id = self.next_ids[table]
+        self.next_ids[table] = row_id + self.id_step
+        return row_id
+
+    def observe_id(self, table, row_id):
+        # keep ids roughly time-ordered across workers by never falling behind a peer
+        if row_id >= self.next_ids[table]:
+            self.next_ids[table] = self._align(row_id + 1)
+
+    def insert(self, sql, params):
+        self.queue.put((sql, params))
+
+    def flush(self):
+        # returns a concurrent Future resolved once everything queued so far is committed
+        fut = Future()
+        self.queue.put(fut)
+        return fut
+
+    def call(self, func, *args):
+        # run func(conn, *args) on the writer thread in its own transaction, after
+        # everything queued before it; returns a concurrent Future with the result
+        fut = Future()
+        self.queue.put((func, args, fut))
+        return fut
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        running = True
+        while running:
+            item = self.queue.get()
+            batch = []
+            waiters = []
+            deadline = time.monotonic() + self.batch_ms / 1000
+            while True:
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, Future) or len(item) == 3:
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_rows:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if batch:
+                if metrics.enabled:
+                    t0 = time.perf_counter()
+                    self._commit(conn, batch)
+                    metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='commit')
+                    metrics.inc('chat_db_rows_written_total', len(batch))
+                else:
+                    self._commit(conn, batch)
+            for item in waiters:
+                if isinstance(item, Future):
+                    item.set_result(None)
+                else:
+                    self._call(conn, *item)
+        conn.close()
+
+    def _call(self, conn, func, args, fut):
+        try:
+            with conn:
+                result = func(conn, *args)
+        except Exception as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(result)
+
+    def _commit(self, conn, batch):
+        try:
+            with conn:
+                for sql, params in batch:
+                    conn.execute(sql, params)
+        except sqlite3.Error:
+            # one bad row must not take the rest of the batch with it
+            for sql, params in batch:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                except sqlite3.Error as e:
+                    print('DB write failed:', e)
+
+db_writer = None
+
+# --- Database read pool ---
+# Reads run on DB_READERS threads. Each thread opens one read-only connection
+# the first time it is used and keeps it, so the schema is parsed once, the page
+# cache stays warm and sqlite3's per-connection statement cache hands back the
+# prepared form of every query string we reuse. In WAL mode these readers never
+# wait for the writer or each other. Jobs are func(conn, *args), like the
+# writer's; run() returns an asyncio future.
+class DBReadPool:
+    def __init__(self, path, size=DB_READERS):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='db-read')
+        self.local = threading.local()
+        self.conns = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute('PRAGMA query_only=ON')
+        conn.execute(f'PRAGMA cache_size=-{DB_READ_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_BYTES}')
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    def _call(self, func, args):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return func(conn, *args)
+
+    def run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, self._call, func, args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns.clear()
+
+db_reader = None
+
 # --- Simple in-memory server state ---
-clients = {}  # writer -> {username, room, fernet (optional)}
-rooms = {}    # room -> set of writers
+class Session:
+    # one per authenticated connection; slots keep idle sessions small
+    __slots__ = ('username', 'room')
+
+    def __init__(self, username):
+        self.username = username
+        self.room = None
+
+class RoomRegistry:
+    # room -> set of writers. Empty rooms are dropped as soon as the last member
+    # leaves. Membership only changes on the loop thread and broadcasts iterate
+    # without awaiting, so members() hands out the live set with no snapshot.
+    EMPTY = frozenset()
+
+    def __init__(self):
+        self.rooms = {}
+
+    def join(self, room, writer):
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+        members.add(writer)
+
+    def leave(self, room, writer):
+        # True if writer was a member
+        members = self.rooms.get(room)
+        if members is None or writer not in members:
+            return False
+        members.discard(writer)
+        if not members:
+            del self.rooms[room]
+        return True
+
+    def members(self, room):
+        return self.rooms.get(room, self.EMPTY)
+
+    def names(self):
+        return list(self.rooms)
+
+    def items(self):
+        return self.rooms.items()
+
+    def __len__(self):
+        return len(self.rooms)
+
+clients = {}            # writer -> Session
+rooms = RoomRegistry()
+outbound = {}           # writer -> Outbound
+
+# --- Outbound queues ---
+# Every connection owns a bounded queue drained by its own writer task, so a
+# slow reader only ever delays itself. Broadcast frames may be dropped under
+# OUTBOUND_POLICY; direct responses (send_json) never are.
+class Outbound:
+    __slots__ = ('writer', 'max_bytes', 'policy', 'queue', 'queued_bytes', 'ready', 'space', 'closed',
+                 'task', 'codec', 'downloads', 'frames_sent', 'bytes_sent', 'dropped', 'last_lag', 'max_lag')
+
+    def __init__(self, writer, max_bytes=OUTBOUND_MAX_BYTES, policy=OUTBOUND_POLICY):
+        if policy not in ('drop_oldest', 'disconnect', 'coalesce'):
+            raise ValueError(f'invalid outbound policy: {policy}')
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.queue = deque()        # (enqueued_at, data or stream coroutine function, droppable)
+        self.queued_bytes = 0
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.task = None
+        self.codec = LINE_JSON      # switched to a binary codec by a hello request
+        self.downloads = 0          # file_get streams queued or in progress
+        # lag metrics
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, data, droppable=True):
+        if self.closed:
+            return
+        if droppable and self.queued_bytes + len(data) > self.max_bytes:
+            if not self._overflow():
+                return
+        self.queue.append((time.monotonic(), data, droppable))
+        self.queued_bytes += len(data)
+        if self.queued_bytes > self.max_bytes:
+            self.space.clear()
+        self.ready.set()
+
+    def put_stream(self, stream):
+        # `stream(writer)` writes raw bytes straight to the socket when its turn comes
+        if self.closed:
+            return
+        self.queue.append((time.monotonic(), stream, False))
+        self.ready.set()
+
+    async def wait_for_space(self):
+        await self.space.wait()
+
+    def _overflow(self):
+        if self.policy == 'disconnect':
+            print('Disconnecting slow client:', self.writer.get_extra_info('peername'))
+            if metrics.enabled:
+                metrics.inc('chat_outbound_disconnects_total')
+            self.closed = True
+            self.writer.transport.abort()
+            return False
+        kept = deque()
+        skipped = 0
+        for item in self.queue:
+            if item[2] and (self.policy == 'coalesce' or self.queued_bytes > self.max_bytes // 2):
+                self.queued_bytes -= len(item[1])
+                skipped += 1
+            else:
+                kept.append(item)
+        self.queue = kept
+        self.dropped += skipped
+        if metrics.enabled and skipped:
+            metrics.inc('chat_outbound_dropped_total', skipped)
+        if self.policy == 'coalesce' and skipped:
+            notice = self.codec.encode({'type': 'system', 'text': f'{skipped} messages skipped (connection too slow)'})
+            self.queue.append((time.monotonic(), notice, False))
+            self.queued_bytes += len(notice)
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                lag = time.monotonic() - self.queue[0][0]
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+                if callable(self.queue[0][1]):
+                    await self.queue.popleft()[1](self.writer)
+                    continue
+                # hand every frame queued so far (up to the next stream) to the transport in one write
+                items = []
+                while self.queue and not callable(self.queue[0][1]):
+                    items.append(self.queue.popleft()[1])
+                data = b''.join(items)
+                self.queued_bytes -= len(data)
+                if self.queued_bytes <= self.max_bytes:
+                    self.space.set()
+                self.writer.write(data)
+                self.frames_sent += len(items)
+                self.bytes_sent += len(data)
+                if metrics.enabled:
+                    metrics.inc('chat_sent_bytes_total', len(data), codec=self.codec.label)
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # includes failures half way through a stream: the peer cannot resync, so drop it
+            self.closed = True
+            self.space.set()
+            self.writer.transport.abort()
+
+    async def close(self, timeout=1.0):
+        # give already-queued frames a moment to go out, then stop the writer task
+        if self.queue and not self.closed:
+            try:
+                await asyncio.wait_for(self._wait_empty(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.closed = True
+        self.space.set()
+        if self.task:
+            self.task.cancel()
+
+    async def _wait_empty(self):
+        while self.queue and not self.task.done():
+            await asyncio.sleep(0.01)
+
+    def stats(self):
+        return {'queued_frames': len(self.queue), 'queued_bytes': self.queued_bytes, 'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent, 'dropped': self.dropped, 'last_lag': self.last_lag,
+                'max_lag': self.max_lag}
 
 # --- Helper functions ---
+def encode_json(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8') + b"\n"
+
 async def send_json(writer, obj):
-    data = json.dumps(obj, separators=(',', ':')).encode('utf-8') + b"\n"
-    writer.write(data)
-    await writer.drain()
+    req = current_request.get()
+    if req is not None and req.rid is not None and req.writer is writer:
+        obj = dict(obj, rid=req.rid)  # correlate the reply with a pipelined request
+    out = outbound.get(writer)
+    if out is None:
+        writer.write(encode_json(obj))
+        await writer.drain()
+        return
+    out.put(out.codec.encode(obj), droppable=False)
+    # backpressure on the requesting connection only
+    await out.wait_for_space()
 
 async def broadcast(room, obj, exclude_writer=None):
-    if room not in rooms:
+    if bus is not None:
+        bus.publish({'kind': 'broadcast', 'room': room, 'obj': obj})
+    broadcast_local(room, obj, exclude_writer)
+
+async def broadcast_message(room, entry, obj):
+    history_cache.append(room, entry)
+    if bus is not None:
+        bus.publish({'kind': 'message', 'room': room, 'entry': entry, 'obj': obj})
+    broadcast_local(room, obj)
+
+def broadcast_local(room, obj, exclude_writer=None):
+    members = rooms.members(room)
+    if not members:
         return
-    data = json.dumps(obj, separators=(',', ':')).encode('utf-8') + b"\n"
-    for w in list(rooms[room]):
+    t0 = time.perf_counter() if metrics.enabled else 0
+    frames = {}  # codec -> encoded frame, so each wire format is encoded once
+    for w in members:
         if w is exclude_writer:
             continue
-        try:
-            w.write(data)
-            await w.drain()
-        except Exception:
-            await unregister(w)
+        out = outbound.get(w)
+        if out is not None:
+            data = frames.get(out.codec)
+            if data is None:
+                data = frames[out.codec] = out.codec.encode(obj)
+            out.put(data)
+    if metrics.enabled:
+        metrics.observe('chat_broadcast_seconds', time.perf_counter() - t0)
+        metrics.inc('chat_broadcast_frames_total', len(members))
+
+# --- Cross-worker room bus ---
+# With --workers N every process owns its own connections, so room events are
+# relayed to the other workers through a hub on a local Unix socket. Each
+# worker also publishes a snapshot of its rooms so list_rooms can show all of them.
+class RoomBus:
+    def __init__(self, path, worker_id):
+        self.path = path
+        self.worker_id = worker_id
+        self.writer = None
+        self.remote_rooms = {}  # worker id -> {room: member count}
+        self.dirty = True
+        self.tasks = []
+        self.main_task = None
+
+    async def start(self):
+        self.main_task = asyncio.current_task()
+        for _ in range(50):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f'cannot reach room bus at {self.path}')
+        self.tasks = [asyncio.create_task(self._listen(reader)), asyncio.create_task(self._publish_rooms())]
+
+    def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def publish(self, event):
+        event['worker'] = self.worker_id
+        self.writer.write(encode_json(event))
+
+    def rooms_changed(self):
+        self.dirty = True
+
+    def all_rooms(self):
+        names = dict.fromkeys(rooms.names())
+        for worker_rooms in self.remote_rooms.values():
+            names.update(dict.fromkeys(worker_rooms))
+        return list(names)
+
+    async def _publish_rooms(self):
+        while True:
+            if self.dirty:
+                self.dirty = False
+                self.publish({'kind': 'rooms', 'rooms': {room: len(members) for room, members in rooms.items()}})
+            await asyncio.sleep(BUS_ROOMS_INTERVAL)
+
+    async def _listen(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                # the parent is gone: carrying on would split the rooms between
+                # workers that can no longer see each other
+                print(f'Worker {self.worker_id}: room bus closed, shutting down', file=sys.stderr)
+                self.main_task.cancel()
+                return
+            event = json.loads(line)
+            kind = event.get('kind')
+            if kind == 'broadcast':
+                broadcast_local(event['room'], event['obj'])
+            elif kind == 'message':
+                db_writer.observe_id('messages', event['entry']['id'])
+                history_cache.append(event['room'], event['entry'])
+                broadcast_local(event['room'], event['obj'])
+            elif kind == 'archived':
+                forget_archived(event['room'])
+            elif kind == 'rooms':
+                if event['worker'] not in self.remote_rooms:
+                    # a worker we have not heard from yet; make sure it learns about us too
+                    self.dirty = True
+                self.remote_rooms[event['worker']] = event['rooms']
+
+bus = None
+
+async def handle_bus_peer(reader, writer, peers):
+    peers.add(writer)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            for peer in peers:
+                if peer is not writer:
+                    peer.write(line)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        peers.discard(writer)
+        writer.close()
+
+async def run_bus_hub(sock):
+    peers = set()
+    server = await asyncio.start_unix_server(lambda r, w: handle_bus_peer(r, w, peers), sock=sock)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+    async with server:
+        await server.serve_forever()
 
 # --- Authentication ---
 def register_user(username, password):
@@ -74,80 +802,964 @@ def register_user(username, password):
     finally:
         conn.close()
 
-def verify_user(username, password):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('SELECT password_hash FROM users WHERE username=?', (username,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
-        return False
-    pw_hash = row[0]
+def get_password_hash(conn, username):
+    row = conn.execute('SELECT password_hash FROM users WHERE username=?', (username,)).fetchone()
+    return row[0] if row else None
+
+def verify_user(password, pw_hash):
+    # bcrypt only; the hash comes from the read pool
     try:
         return bcrypt.checkpw(password.encode('utf-8'), pw_hash)
     except Exception:
         return False
 
+# --- Auth worker pool ---
+# bcrypt is deliberately slow; keep it off the event loop so other rooms keep flowing.
+class AuthBusy(Exception):
+    pass
+
+_auth_executor = None
+_auth_pending = 0
+
+def get_auth_executor():
+    global _auth_executor
+    if _auth_executor is None:
+        if AUTH_POOL == 'process':
+            _auth_executor = ProcessPoolExecutor(max_workers=AUTH_WORKERS)
+        else:
+            _auth_executor = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix='auth')
+    return _auth_executor
+
+def shutdown_auth_executor():
+    global _auth_executor
+    if _auth_executor is not None:
+        _auth_executor.shutdown(wait=False, cancel_futures=True)
+        _auth_executor = None
+
+async def run_auth(func, *args):
+    global _auth_pending
+    if _auth_pending >= AUTH_WORKERS + AUTH_QUEUE_SIZE:
+        if metrics.enabled:
+            metrics.inc('chat_auth_busy_total', op=func.__name__)
+        raise AuthBusy()
+    _auth_pending += 1
+    t0 = time.perf_counter() if metrics.enabled else 0
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_auth_executor(), func, *args)
+    finally:
+        _auth_pending -= 1
+        if metrics.enabled:
+            metrics.observe('chat_auth_seconds', time.perf_counter() - t0, op=func.__name__)
+
+# --- Session tokens ---
+# login_response carries a Fernet token (HMAC-signed, timestamped) naming the
+# user. A reconnecting client sends it in a resume request instead of its
+# password, so a flapping network costs an HMAC check rather than a bcrypt.
+session_fernet = None
+
+def load_session_key(path=SESSION_KEY_FILE):
+    # kept on disk so tokens survive restarts and every worker shares the key
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return Fernet(f.read().strip())
+    key = Fernet.generate_key()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return Fernet(key)
+
+def issue_session_token(username):
+    return session_fernet.encrypt(json.dumps({'u': username}).encode()).decode()
+
+def check_session_token(token):
+    try:
+        return json.loads(session_fernet.decrypt(token.encode(), ttl=SESSION_TTL))['u']
+    except (InvalidToken, AttributeError, ValueError, KeyError, TypeError):
+        return None
+
 # --- Message persistence ---
-def store_message(room, sender, text):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('INSERT INTO messages (room, sender, text, ts) VALUES (?, ?, ?, ?)',
-              (room, sender, text, datetime.utcnow()))
-    conn.commit()
-    conn.close()
+def store_message(room, sender, text, ts=None):
+    t0 = time.perf_counter() if metrics.enabled else 0
+    msg_id = db_writer.allocate_id('messages')
+    db_writer.insert('INSERT INTO messages (id, room, sender, text, ts) VALUES (?, ?, ?, ?, ?)',
+                     (msg_id, room, sender, text, ts or datetime.utcnow()))
+    if db_writer.search:
+        # same writer batch as the row itself, so the index never runs ahead of it
+        db_writer.insert('INSERT INTO messages_fts (rowid, text, room) VALUES (?, ?, ?)', (msg_id, text, room))
+    if metrics.enabled:
+        metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='store_message')
+    return msg_id
 
-def get_recent_messages(room, limit=100):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('SELECT sender, text, ts FROM messages WHERE room=? ORDER BY id DESC LIMIT ?', (room, limit))
-    rows = c.fetchall()
-    conn.close()
-    return [{'sender': r[0], 'text': r[1], 'ts': r[2]} for r in reversed(rows)]
+def get_recent_messages(conn, room, limit=HISTORY_LIMIT, before_id=None, since_id=None):
+    # keyset pagination on idx_messages_room_id, returned oldest first: the
+    # newest `limit` rows below before_id, or the oldest `limit` rows above
+    # since_id so a catch-up can page forward without gaps
+    sql = 'SELECT id, sender, text, ts FROM messages WHERE room=?'
+    params = [room]
+    if before_id is not None:
+        sql += ' AND id<?'
+        params.append(before_id)
+    if since_id is not None:
+        sql += ' AND id>?'
+        params.append(since_id)
+    forward = since_id is not None and before_id is None
+    rows = conn.execute(sql + (' ORDER BY id ASC' if forward else ' ORDER BY id DESC') + ' LIMIT ?',
+                        params + [limit]).fetchall()
+    if not forward:
+        rows.reverse()
+    return [{'id': r[0], 'sender': r[1], 'text': r[2], 'ts': r[3]} for r in rows]
+
+# --- Search ---
+def fts_query(text):
+    # each word becomes a quoted FTS5 string so user input cannot inject query
+    # syntax; a trailing * keeps prefix matching
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def search_messages(conn, query, room, limit, offset):
+    # bm25 ranking via the hidden rank column
+    sql = '''SELECT m.id, m.room, m.sender, m.text, m.ts, snippet(messages_fts, 0, '[', ']', '...', 12)
+             FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+             WHERE messages_fts MATCH ?'''
+    params = [query]
+    if room is not None:
+        sql += ' AND messages_fts.room = ?'
+        params.append(room)
+    rows = conn.execute(sql + ' ORDER BY rank LIMIT ? OFFSET ?', params + [limit + 1, offset]).fetchall()
+    return [{'id': r[0], 'room': r[1], 'sender': r[2], 'text': r[3], 'ts': r[4], 'snippet': r[5]}
+            for r in rows[:limit]], len(rows) > limit
+
+async def handle_search(msg, writer):
+    # archive: true searches the archived messages instead of the live index
+    archive = bool(msg.get('archive'))
+    if not db_writer.search and not archive:
+        await send_json(writer, {'type': 'error', 'reason': 'search_unavailable'})
+        return
+    text = str(msg.get('query') or '')
+    if archive:
+        search, query = search_archive, [w.rstrip('*').lower() for w in text.split() if w.rstrip('*')]
+    else:
+        search, query = search_messages, fts_query(text)
+    room = msg.get('room')  # omitted: search every room
+    limit = min(page_limit(msg.get('limit'), SEARCH_PAGE), SEARCH_PAGE * 5)
+    offset = msg.get('offset', 0)
+    if not query or not isinstance(offset, int) or not 0 <= offset <= SEARCH_MAX_OFFSET:
+        await send_json(writer, {'type': 'error', 'reason': 'bad_query'})
+        return
+    t0 = time.perf_counter() if metrics.enabled else 0
+    # messages still queued in the writer are not in the FTS index yet
+    await asyncio.wrap_future(db_writer.flush())
+    try:
+        results, more = await db_reader.run(search, query, room, limit, offset)
+    except sqlite3.OperationalError:
+        await send_json(writer, {'type': 'error', 'reason': 'bad_query'})
+        return
+    if metrics.enabled:
+        metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='search_archive' if archive else 'search')
+    next_offset = offset + limit if more and offset + limit <= SEARCH_MAX_OFFSET else None
+    await send_json(writer, {'type': 'search_results', 'query': msg.get('query'), 'room': room, 'archive': archive,
+                             'results': results, 'next_offset': next_offset})
+
+# --- Retention and archive ---
+# A retention pass (worker 0 only, every RETENTION_INTERVAL) moves messages past
+# their room's age or count limit, and files past the age limit, out of the live
+# tables into gzip JSONL partitions under ARCHIVE_DIR/<room>/<YYYY-MM>. Each
+# batch is one DBWriter job: the rows are appended to the partition (a new gzip
+# member) and fsynced before the delete commits, so a crash in between can only
+# leave a row in both places, and archive readers skip ids they have seen.
+# Freed pages are handed back afterwards with incremental_vacuum in small steps.
+def retention_policy(room):
+    return RETENTION_ROOMS.get(room, (RETENTION_DAYS, RETENTION_MAX_MESSAGES))
+
+def archive_path(room, month, kind='messages'):
+    # the prefix keeps room names like '..' from meaning anything to the filesystem
+    suffix = '' if kind == 'messages' else f'.{kind}'
+    return os.path.join(ARCHIVE_DIR, 'r_' + quote(room, safe=''), f'{month}{suffix}.jsonl.gz')
+
+def append_archive(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records).encode('utf-8')
+    with open(path, 'ab') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='ab', compresslevel=6, mtime=0) as gz:
+            gz.write(data)
+        raw.flush()
+        os.fsync(raw.fileno())
+
+def by_month(records):
+    months = {}
+    for r in records:
+        months.setdefault(str(r['ts'])[:7], []).append(r)
+    return months
+
+def retire_messages(conn, room, cutoff, keep, limit):
+    # writer thread: archive and delete up to `limit` of the room's oldest
+    # messages that are older than cutoff or beyond the newest `keep`
+    clauses = []
+    params = [room]
+    if cutoff is not None:
+        clauses.append('ts < ?')
+        params.append(cutoff)
+    if keep is not None:
+        row = conn.execute('SELECT id FROM messages WHERE room=? ORDER BY id DESC LIMIT 1 OFFSET ?',
+                           (room, keep)).fetchone()
+        if row is not None:
+            clauses.append('id <= ?')
+            params.append(row[0])
+    if not clauses:
+        return 0
+    rows = conn.execute(f'SELECT id, sender, text, ts FROM messages WHERE room=? AND ({" OR ".join(clauses)}) '
+                        'ORDER BY id LIMIT ?', params + [limit]).fetchall()
+    if not rows:
+        return 0
+    records = [{'id': r[0], 'room': room, 'sender': r[1], 'text': r[2], 'ts': r[3]} for r in rows]
+    for month, part in by_month(records).items():
+        path = archive_path(room, month)
+        append_archive(path, part)
+        ids = [r['id'] for r in part]
+        conn.execute('INSERT INTO archives (room, month, path, min_id, max_id, rows) VALUES (?, ?, ?, ?, ?, ?) '
+                     'ON CONFLICT(room, month) DO UPDATE SET min_id = min(min_id, excluded.min_id), '
+                     'max_id = max(max_id, excluded.max_id), rows = rows + excluded.rows',
+                     (room, month, path, min(ids), max(ids), len(ids)))
+    raise_id_floor(conn, 'messages', max(r[0] for r in rows))
+    conn.executemany('DELETE FROM messages WHERE id=?', [(r[0],) for r in rows])
+    if db_writer.search:
+        # external-content FTS5 needs the old values to drop a row from the index
+        conn.executemany("INSERT INTO messages_fts (messages_fts, rowid, text, room) VALUES ('delete', ?, ?, ?)",
+                         [(r[0], r[2], room) for r in rows])
+    return len(rows)
+
+def raise_id_floor(conn, table, row_id):
+    # writer thread: remember row_id before its row goes, so restarts do not hand it out again
+    conn.execute('INSERT INTO id_floors (tbl, last_id) VALUES (?, ?) '
+                 'ON CONFLICT(tbl) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)', (table, row_id))
+
+def retire_files(conn, room, cutoff):
+    # writer thread: archive the metadata of files shared before cutoff and drop
+    # their references; blob_gc removes the bytes once nothing else uses them
+    rows = conn.execute('SELECT id, sender, filename, sha256, size, ts FROM files WHERE room=? AND ts < ?',
+                        (room, cutoff.isoformat())).fetchall()
+    if not rows:
+        return 0
+    records = [{'id': r[0], 'room': room, 'sender': r[1], 'filename': r[2], 'sha256': r[3], 'size': r[4],
+                'ts': r[5]} for r in rows]
+    for month, part in by_month(records).items():
+        append_archive(archive_path(room, month, 'files'), part)
+    release_files(conn, [r[0] for r in rows])
+    return len(rows)
+
+def merge_search_index(conn):
+    # writer thread: fold some of the delete markers into the index segments
+    conn.execute("INSERT INTO messages_fts (messages_fts, rank) VALUES ('merge', 500)")
+
+def vacuum_step(conn, pages):
+    # writer thread: returns the number of free pages left
+    conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+    return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+def rooms_with_rows(conn):
+    return [r[0] for r in conn.execute('SELECT room FROM messages GROUP BY room UNION SELECT room FROM files')]
+
+async def run_retention():
+    moved = released = 0
+    for room in await db_reader.run(rooms_with_rows):
+        days, keep = retention_policy(room)
+        if days is None and keep is None:
+            continue
+        cutoff = datetime.utcnow() - timedelta(days=days) if days is not None else None
+        room_moved = 0
+        while True:
+            n = await asyncio.wrap_future(db_writer.call(retire_messages, room, cutoff, keep, RETENTION_BATCH))
+            room_moved += n
+            if n < RETENTION_BATCH:
+                break
+        if cutoff is not None:
+            released += await asyncio.wrap_future(db_writer.call(retire_files, room, cutoff))
+        if room_moved:
+            # the ring may hold rows that just left; let the next join refill it
+            forget_archived(room)
+            if bus is not None:
+                bus.publish({'kind': 'archived', 'room': room})
+            moved += room_moved
+    if moved and db_writer.search:
+        await asyncio.wrap_future(db_writer.call(merge_search_index))
+    free = None
+    while True:
+        # stops early on databases without incremental auto-vacuum, where nothing is freed
+        left = await asyncio.wrap_future(db_writer.call(vacuum_step, VACUUM_PAGES))
+        if left == 0 or left == free:
+            break
+        free = left
+    if moved or released:
+        print(f'Retention archived {moved} messages and {released} files')
+
+async def retention_loop():
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL)
+        try:
+            await run_retention()
+        except Exception as e:
+            print('Retention pass failed:', e)
+
+def lowest_archived_id(conn, room):
+    return conn.execute('SELECT MIN(min_id) FROM archives WHERE room=?', (room,)).fetchone()[0]
+
+archive_floors = {}  # room -> lowest archived message id (None: nothing archived), until the next retention pass
+
+async def has_archived_before(room, before_id):
+    # asked on every join of a room the ring holds completely, so the answer is
+    # cached rather than costing a read per join
+    if room not in archive_floors:
+        archive_floors[room] = await db_reader.run(lowest_archived_id, room)
+    floor = archive_floors[room]
+    return floor is not None and (before_id is None or floor < before_id)
+
+def forget_archived(room):
+    # rows of room just moved to the archive: the ring and floor are stale
+    history_cache.discard(room)
+    archive_floors.pop(room, None)
+
+def load_partition(path):
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+    except FileNotFoundError:
+        return []
+
+def read_archive(conn, room, before_id, limit):
+    # the newest `limit` archived messages of room below before_id, oldest
+    # first, and whether more remain; partitions are read newest first
+    if before_id is None:
+        before_id = 2 ** 63 - 1
+    paths = [r[0] for r in conn.execute('SELECT path FROM archives WHERE room=? AND min_id < ? ORDER BY max_id DESC',
+                                        (room, before_id))]
+    found = {}
+    for path in paths:
+        if len(found) > limit:
+            break
+        for m in load_partition(path):
+            if m['id'] < before_id:
+                found[m['id']] = m
+    ids = sorted(found)
+    return [found[i] for i in ids[-limit:]], len(ids) > limit
+
+def search_archive(conn, words, room, limit, offset):
+    # plain substring match over the archive, newest partition first; every
+    # word has to appear. Slow by design, clients ask for it explicitly.
+    sql = 'SELECT path FROM archives'
+    params = ()
+    if room is not None:
+        sql += ' WHERE room=?'
+        params = (room,)
+    paths = [r[0] for r in conn.execute(sql + ' ORDER BY max_id DESC', params)]
+    hits = []
+    seen = set()
+    for path in paths:
+        for m in reversed(load_partition(path)):
+            text = (m.get('text') or '').lower()
+            if m['id'] not in seen and all(w in text for w in words):
+                seen.add(m['id'])
+                hits.append(dict(m, snippet=m.get('text', '')[:120]))
+        if len(hits) > offset + limit:
+            break
+    return hits[offset:offset + limit], len(hits) > offset + limit
+
+# --- Room history cache ---
+# Ring buffer of the last HISTORY_LIMIT messages per room, filled from SQLite on
+# first access and kept current by the message handler. Whole rooms are evicted
+# least-recently-used first once the cache goes over its memory budget. Each
+# ring stays sorted by id: with --workers, ids come from per-worker sequences
+# and a peer's message can arrive after a newer local one.
+class HistoryCache:
+    ENTRY_OVERHEAD = 200  # rough per-message cost of the dict, deque slot and ts string
+
+    def __init__(self, depth=HISTORY_LIMIT, max_bytes=HISTORY_CACHE_BYTES):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.rooms = OrderedDict()  # room -> deque of message dicts, in id order
+        self.room_bytes = {}
+        self.total_bytes = 0
+        self.filling = {}           # room -> messages appended while a fill is in flight
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_size(self, m):
+        return self.ENTRY_OVERHEAD + len(m['text'] or '') + len(m['sender'] or '')
+
+    def get(self, room):
+        buf = self.rooms.get(room)
+        if buf is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.rooms.move_to_end(room)
+        return list(buf)
+
+    def begin_fill(self, room):
+        self.filling.setdefault(room, [])
+
+    def fill(self, room, messages):
+        pending = self.filling.pop(room, [])
+        if room in self.rooms:
+            return self.get(room)
+        # pending may overlap the read (committed before it) or fall between its
+        # rows (a peer's message not yet committed when we read)
+        merged = {m['id']: m for m in messages}
+        for m in pending:
+            merged.setdefault(m['id'], m)
+        buf = deque(sorted(merged.values(), key=lambda m: m['id']), maxlen=self.depth)
+        size = sum(self._entry_size(m) for m in buf)
+        self.rooms[room] = buf
+        self.room_bytes[room] = size
+        self.total_bytes += size
+        self._evict()
+        return list(buf)
+
+    def append(self, room, m):
+        buf = self.rooms.get(room)
+        if buf is None:
+            if room in self.filling:
+                self.filling[room].append(m)
+            return
+        # find m's place from the right: almost always the end
+        i = len(buf)
+        while i and buf[i - 1]['id'] > m['id']:
+            i -= 1
+        if i and buf[i - 1]['id'] == m['id']:
+            return
+        size = self._entry_size(m)
+        if len(buf) == buf.maxlen:
+            if i == 0:
+                return  # older than anything the full ring keeps
+            size -= self._entry_size(buf.popleft())
+            i -= 1
+        buf.insert(i, m)
+        self.room_bytes[room] += size
+        self.total_bytes += size
+        self._evict()
+
+    def discard(self, room):
+        if room in self.rooms:
+            del self.rooms[room]
+            self.total_bytes -= self.room_bytes.pop(room)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.rooms) > 1:
+            room, _ = self.rooms.popitem(last=False)
+            self.total_bytes -= self.room_bytes.pop(room)
+            self.evictions += 1
+
+    def stats(self):
+        return {'rooms': len(self.rooms), 'bytes': self.total_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+history_cache = HistoryCache()
+
+async def get_room_history(room):
+    messages = history_cache.get(room)
+    if messages is not None:
+        return messages
+    history_cache.begin_fill(room)
+    t0 = time.perf_counter() if metrics.enabled else 0
+    # make sure rows still queued in the writer are visible to the read
+    await asyncio.wrap_future(db_writer.flush())
+    messages = await db_reader.run(get_recent_messages, room, history_cache.depth)
+    if metrics.enabled:
+        metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='get_recent_messages')
+    return history_cache.fill(room, messages)
+
+async def get_history_page(room, limit, before_id=None, since_id=None, archive=False):
+    # returns (messages oldest first, whether older messages exist before them).
+    # Once the live table runs out, has_more reports archived messages; with
+    # archive=True the page is topped up from the archive files. A since_id page
+    # is the oldest `limit` messages above since_id instead, and has_more says
+    # newer ones remain (ask again from the page's last id).
+    page, has_more = await get_live_page(room, limit, before_id, since_id)
+    if has_more or since_id is not None:
+        return page, has_more
+    boundary = page[0]['id'] if page else before_id
+    if not archive or len(page) == limit:
+        return page, await has_archived_before(room, boundary)
+    t0 = time.perf_counter() if metrics.enabled else 0
+    older, has_more = await db_reader.run(read_archive, room, boundary, limit - len(page))
+    if metrics.enabled:
+        metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='archive_page')
+    return older + page, has_more
+
+async def get_live_page(room, limit, before_id, since_id):
+    cached = await get_room_history(room)
+    window = [m for m in cached
+              if (before_id is None or m['id'] < before_id) and (since_id is None or m['id'] > since_id)]
+    # the ring holds every message of the room newer than its oldest entry
+    whole_room = len(cached) < history_cache.depth
+    if since_id is not None:
+        if whole_room or (cached and cached[0]['id'] <= since_id):
+            return window[:limit], len(window) > limit
+    elif len(window) > limit:
+        return window[-limit:], True
+    elif whole_room:
+        return window, False
+    t0 = time.perf_counter() if metrics.enabled else 0
+    await asyncio.wrap_future(db_writer.flush())
+    rows = await db_reader.run(get_recent_messages, room, limit + 1, before_id, since_id)
+    if metrics.enabled:
+        metrics.observe('chat_db_seconds', time.perf_counter() - t0, op='history_page')
+    return (rows[:limit] if since_id is not None else rows[-limit:]), len(rows) > limit
+
+def page_limit(value, default):
+    try:
+        return max(1, min(int(value), HISTORY_PAGE_MAX))
+    except (TypeError, ValueError):
+        return default
+
+def message_id_arg(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) and value >= 0 else None
 
 # --- File storage ---
-FILES_DIR = 'uploads'
-os.makedirs(FILES_DIR, exist_ok=True)
+# Uploaded bytes live once per sha256 under uploads/blobs/ab/cd/<sha256>. Each
+# share in a room is a files row pointing at its blob; blobs carry a reference
+# count and are garbage-collected once nothing points at them. All blob moves
+# and refcount changes run as DBWriter jobs so they serialize with the GC.
+PARTIAL_DIR = os.path.join(FILES_DIR, '.partial')
+BLOBS_DIR = os.path.join(FILES_DIR, 'blobs')
+
+def init_file_dirs():
+    # called once settings are final, since FILES_DIR may have been overridden
+    global PARTIAL_DIR, BLOBS_DIR
+    PARTIAL_DIR = os.path.join(FILES_DIR, '.partial')
+    BLOBS_DIR = os.path.join(FILES_DIR, 'blobs')
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    os.makedirs(BLOBS_DIR, exist_ok=True)
+
+def blob_path(digest):
+    return os.path.join(BLOBS_DIR, digest[:2], digest[2:4], digest)
+
+def attach_blob(conn, digest, size, src_path, file_row):
+    # writer thread: store src_path under its hash (or reuse the existing blob
+    # when src_path is None) and add a files row referencing it
+    row = conn.execute('SELECT path, size FROM blobs WHERE sha256=?', (digest,)).fetchone()
+    have_blob = row is not None and row[1] == size and os.path.exists(row[0])
+    if src_path is None:
+        if not have_blob:
+            return None
+    elif have_blob:
+        os.unlink(src_path)
+    else:
+        path = blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+    path = row[0] if have_blob else blob_path(digest)
+    conn.execute('INSERT INTO blobs (sha256, path, size, refcount, created_at) VALUES (?, ?, ?, 1, ?) '
+                 'ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1, released_at = NULL',
+                 (digest, path, size, datetime.utcnow()))
+    file_id, room, sender, filename, ts = file_row
+    conn.execute('INSERT INTO files (id, room, sender, filename, path, ts, sha256, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (file_id, room, sender, filename, path, ts, digest, size))
+    return path
+
+def release_files(conn, file_ids):
+    # writer thread: drop files rows and the blob references they held
+    if file_ids:
+        raise_id_floor(conn, 'files', max(file_ids))
+    for file_id in file_ids:
+        row = conn.execute('SELECT sha256, path FROM files WHERE id=?', (file_id,)).fetchone()
+        if row is None:
+            continue
+        conn.execute('DELETE FROM files WHERE id=?', (file_id,))
+        if row[0]:
+            conn.execute('UPDATE blobs SET refcount = refcount - 1, '
+                         'released_at = CASE WHEN refcount - 1 <= 0 THEN ? ELSE released_at END WHERE sha256=?',
+                         (datetime.utcnow(), row[0]))
+        elif row[1]:
+            # a row from before the blob store owns its file outright
+            try:
+                os.unlink(row[1])
+            except FileNotFoundError:
+                pass
+
+def collect_blobs(conn, orphans):
+    # writer thread: delete blobs nobody has referenced for BLOB_GC_GRACE seconds,
+    # plus files under BLOBS_DIR that never made it into the table
+    cutoff = datetime.utcnow().timestamp() - BLOB_GC_GRACE
+    rows = conn.execute('SELECT sha256, path FROM blobs WHERE refcount <= 0 AND released_at < ?',
+                        (datetime.utcfromtimestamp(cutoff),)).fetchall()
+    conn.executemany('DELETE FROM blobs WHERE sha256=?', [(r[0],) for r in rows])
+    paths = {r[1] for r in rows}
+    for path in orphans:
+        if conn.execute('SELECT 1 FROM blobs WHERE sha256=?', (os.path.basename(path),)).fetchone() is None:
+            paths.add(path)
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    return len(paths)
+
+def find_orphan_blobs():
+    cutoff = time.time() - BLOB_GC_GRACE
+    orphans = []
+    for dirpath, _, names in os.walk(BLOBS_DIR):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if os.path.getmtime(path) < cutoff:
+                orphans.append(path)
+    return orphans
+
+async def blob_gc():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(BLOB_GC_INTERVAL)
+        try:
+            orphans = await loop.run_in_executor(None, find_orphan_blobs)
+            removed = await asyncio.wrap_future(db_writer.call(collect_blobs, orphans))
+            if removed:
+                print('Blob GC removed', removed, 'files')
+        except Exception as e:
+            print('Blob GC failed:', e)
+
+async def record_file(room, sender, filename, digest, size, src_path=None):
+    # persist file meta and notify room; with src_path None this only succeeds if
+    # the blob is already stored, which is how repeat uploads are skipped
+    file_id = db_writer.allocate_id('files')
+    ts = datetime.utcnow().isoformat()
+    path = await asyncio.wrap_future(db_writer.call(attach_blob, digest, size, src_path,
+                                                    (file_id, room, sender, filename, ts)))
+    if path is None:
+        return None
+    await broadcast(room, {'type': 'file_shared', 'id': file_id, 'room': room, 'sender': sender,
+                           'filename': filename, 'path': path, 'sha256': digest, 'size': size, 'ts': ts})
+    return file_id
+
+def get_file_record(conn, file_id):
+    return conn.execute('SELECT path, filename FROM files WHERE id=?', (file_id,)).fetchone()
+
+def write_and_hash(f, hasher, chunk):
+    f.write(chunk)
+    hasher.update(chunk)
 
 async def handle_file_transfer(meta, reader, writer):
-    # meta: {filename, size, room, sender}
+    # legacy single-shot upload: meta {filename, size, room, sender} followed by raw bytes
+    t0 = time.perf_counter() if metrics.enabled else 0
     filename = os.path.basename(meta['filename'])
     size = int(meta['size'])
     room = meta['room']
     sender = meta['sender']
-    ts = datetime.utcnow().isoformat()
-    out_path = os.path.join(FILES_DIR, f"{int(datetime.utcnow().timestamp())}_{filename}")
-    with open(out_path, 'wb') as f:
+    tmp_path = os.path.join(PARTIAL_DIR, f'{os.getpid()}_{id(writer)}_{time.monotonic_ns()}.tmp')
+    hasher = hashlib.sha256()
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, tmp_path, 'wb')
+    try:
         remaining = size
         while remaining > 0:
             chunk = await reader.read(min(CHUNK_SIZE, remaining))
             if not chunk:
                 break
-            f.write(chunk)
+            await loop.run_in_executor(None, write_and_hash, f, hasher, chunk)
             remaining -= len(chunk)
-    # persist file meta
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('INSERT INTO files (room, sender, filename, path, ts) VALUES (?, ?, ?, ?, ?)',
-              (room, sender, filename, out_path, ts))
-    conn.commit()
-    conn.close()
-    # notify room
-    await broadcast(room, {'type': 'file_shared', 'room': room, 'sender': sender, 'filename': filename, 'path': out_path, 'ts': ts})
+    finally:
+        await loop.run_in_executor(None, f.close)
+    if remaining:
+        # client went away mid-transfer; never publish a truncated file
+        await loop.run_in_executor(None, os.unlink, tmp_path)
+        return
+    if metrics.enabled:
+        metrics.observe('chat_file_transfer_seconds', time.perf_counter() - t0)
+        metrics.inc('chat_file_bytes_total', size)
+    await record_file(room, sender, filename, hasher.hexdigest(), size, tmp_path)
+
+# --- Resumable uploads ---
+# upload_start -> upload_ready {upload_id, offset}; then any number of
+# upload_chunk headers, each followed by `size` raw bytes and answered with
+# upload_ack/upload_error carrying the committed offset; finally upload_finish
+# checks the whole-file sha256 and publishes the file. Partial data lives in
+# uploads/.partial so an interrupted transfer resumes from its last good chunk,
+# even across server restarts. All disk work runs in the default executor.
+class Upload:
+    def __init__(self, upload_id, filename, size, sha256, sender):
+        self.id = upload_id
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.sender = sender
+        self.part_path = os.path.join(PARTIAL_DIR, upload_id + '.part')
+        self.meta_path = os.path.join(PARTIAL_DIR, upload_id + '.json')
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        self.file = None
+        self.lock = asyncio.Lock()
+        self.touched = time.monotonic()
+
+    def open(self):
+        # runs in a worker thread: pick up any bytes from an earlier attempt
+        if os.path.exists(self.part_path) and os.path.getsize(self.part_path) <= self.size:
+            with open(self.part_path, 'rb') as f:
+                while True:
+                    block = f.read(CHUNK_SIZE * 16)
+                    if not block:
+                        break
+                    self.hasher.update(block)
+                    self.offset += len(block)
+            self.file = open(self.part_path, 'ab')
+        else:
+            self.file = open(self.part_path, 'wb')
+        with open(self.meta_path, 'w') as f:
+            json.dump({'filename': self.filename, 'size': self.size, 'sha256': self.sha256, 'sender': self.sender}, f)
+
+    def write_chunk(self, data, digest):
+        if digest and hashlib.sha256(data).hexdigest() != digest:
+            return False
+        self.file.write(data)
+        self.file.flush()
+        self.hasher.update(data)
+        self.offset += len(data)
+        return True
+
+    def complete(self):
+        self.file.close()
+        os.unlink(self.meta_path)
+
+    def discard(self):
+        self.file.close()
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+uploads = {}  # upload_id -> Upload being received
+
+def cleanup_partial_uploads():
+    cutoff = time.time() - UPLOAD_PARTIAL_TTL
+    for name in os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        if os.path.getmtime(path) < cutoff:
+            os.unlink(path)
+
+async def upload_janitor():
+    # close handles of abandoned uploads (their bytes stay on disk for resume)
+    # and drop partial files nobody came back for
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(UPLOAD_IDLE_CLOSE)
+        cutoff = time.monotonic() - UPLOAD_IDLE_CLOSE
+        try:
+            for upload_id, up in list(uploads.items()):
+                if up.touched < cutoff and not up.lock.locked():
+                    uploads.pop(upload_id, None)
+                    if up.file is not None:
+                        await loop.run_in_executor(None, up.file.close)
+            await loop.run_in_executor(None, cleanup_partial_uploads)
+        except Exception as e:
+            print('Upload janitor failed:', e)
+
+async def start_upload(msg, writer, username, room):
+    filename = os.path.basename(str(msg.get('filename', '')))
+    digest = str(msg.get('sha256', '')).lower()
+    try:
+        size = int(msg['size'])
+    except (KeyError, TypeError, ValueError):
+        size = -1
+    if not filename or size < 0 or len(digest) != 64:
+        await send_json(writer, {'type': 'upload_error', 'upload_id': None, 'reason': 'bad_upload', 'offset': 0})
+        return
+    # the same user re-sending the same file always lands on the same upload id
+    upload_id = hashlib.sha256(f'{username}\0{digest}\0{size}'.encode('utf-8')).hexdigest()[:32]
+    if upload_id not in uploads:
+        # content we already have: share it without transferring a byte
+        file_id = await record_file(room, username, filename, digest, size)
+        if file_id is not None:
+            await send_json(writer, {'type': 'upload_done', 'upload_id': upload_id, 'file_id': file_id, 'deduplicated': True})
+            return
+    up = uploads.get(upload_id)
+    if up is None:
+        up = uploads[upload_id] = Upload(upload_id, filename, size, digest, username)
+        async with up.lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, up.open)
+            except OSError as e:
+                # do not leave a half-open upload behind for the next attempt to trip over
+                uploads.pop(upload_id, None)
+                if up.file is not None:
+                    up.file.close()
+                print('Upload open failed:', e)
+                await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'storage_error', 'offset': 0})
+                return
+    await send_json(writer, {'type': 'upload_ready', 'upload_id': upload_id, 'offset': up.offset})
+
+async def receive_upload_chunk(msg, reader, writer, username):
+    try:
+        length = int(msg['size'])
+        offset = int(msg['offset'])
+    except (KeyError, TypeError, ValueError):
+        length = offset = -1
+    if not 0 < length <= UPLOAD_MAX_CHUNK:
+        # we cannot find the next frame without a valid length, so give up on the connection
+        raise ConnectionError('bad upload_chunk size')
+    data = await reader.readexactly(length)
+    release_reader()
+    upload_id = msg.get('upload_id')
+    up = uploads.get(upload_id)
+    if up is None or up.sender != username:
+        # someone else's upload looks exactly like a missing one
+        await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'unknown_upload', 'offset': 0})
+        return
+    up.touched = time.monotonic()
+    async with up.lock:
+        if offset != up.offset or up.offset + length > up.size:
+            reason = 'bad_offset'
+        elif not await asyncio.get_running_loop().run_in_executor(None, up.write_chunk, data, msg.get('sha256')):
+            reason = 'chunk_checksum'
+        else:
+            reason = None
+        committed = up.offset
+    if metrics.enabled and reason is None:
+        metrics.inc('chat_file_bytes_total', length)
+    if reason:
+        await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': reason, 'offset': committed})
+    else:
+        await send_json(writer, {'type': 'upload_ack', 'upload_id': upload_id, 'offset': committed})
+
+async def finish_upload(msg, writer, username, room):
+    upload_id = msg.get('upload_id')
+    up = uploads.get(upload_id)
+    if up is None or up.sender != username:
+        await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'unknown_upload', 'offset': 0})
+        return
+    loop = asyncio.get_running_loop()
+    async with up.lock:
+        if up.offset != up.size:
+            await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'incomplete', 'offset': up.offset})
+            return
+        uploads.pop(upload_id, None)
+        if up.hasher.hexdigest() != up.sha256:
+            await loop.run_in_executor(None, up.discard)
+            await send_json(writer, {'type': 'upload_error', 'upload_id': upload_id, 'reason': 'checksum_mismatch', 'offset': 0})
+            return
+        await loop.run_in_executor(None, up.complete)
+        file_id = await record_file(room, up.sender, up.filename, up.sha256, up.size, up.part_path)
+    await send_json(writer, {'type': 'upload_done', 'upload_id': upload_id, 'file_id': file_id})
+
+# --- File downloads ---
+# file_get {id, range: "bytes=start-end"} is answered with a file_data header
+# {id, filename, size, offset, length} followed by exactly `length` raw bytes.
+# The bytes go out through the connection's outbound queue so they never land
+# in the middle of another frame; plain TCP uses sendfile, TLS reads chunks in
+# the executor.
+def parse_range(spec, size):
+    if not spec:
+        return 0, size
+    try:
+        unit, _, value = str(spec).partition('=')
+        start, _, end = value.partition('-')
+        if unit.strip() != 'bytes':
+            return None
+        if not start:
+            # suffix range: the last N bytes
+            n = min(int(end), size)
+            return size - n, n
+        start = int(start)
+        if not end and start == size:
+            # nothing left from here: an empty file, or a resume that already has every byte
+            return start, 0
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end:
+        return None
+    return start, end - start + 1
+
+def read_at(f, pos, n):
+    f.seek(pos)
+    return f.read(n)
+
+async def stream_file(writer, f, offset, count):
+    if count == 0:
+        return  # loop.sendfile rejects a zero count
+    loop = asyncio.get_running_loop()
+    if writer.get_extra_info('sslcontext') is None:
+        try:
+            await loop.sendfile(writer.transport, f, offset, count, fallback=False)
+            return
+        except (NotImplementedError, AttributeError, asyncio.SendfileNotAvailableError):
+            # AttributeError: uvloop's loop has no sendfile
+            pass
+    pos = offset
+    remaining = count
+    while remaining > 0:
+        chunk = await loop.run_in_executor(None, read_at, f, pos, min(DOWNLOAD_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise OSError('file shrank during download')
+        writer.write(chunk)
+        await writer.drain()
+        pos += len(chunk)
+        remaining -= len(chunk)
+
+async def send_file_download(msg, writer):
+    out = outbound[writer]
+    file_id = msg.get('id')
+    if out.downloads >= MAX_DOWNLOADS_PER_CONN:
+        await send_json(writer, {'type': 'file_error', 'id': file_id, 'reason': 'too_many_downloads'})
+        return
+    loop = asyncio.get_running_loop()
+    row = await db_reader.run(get_file_record, file_id)
+    if row is None:
+        # the row may still be sitting in the writer queue
+        await asyncio.wrap_future(db_writer.flush())
+        row = await db_reader.run(get_file_record, file_id)
+    if row is None:
+        await send_json(writer, {'type': 'file_error', 'id': file_id, 'reason': 'not_found'})
+        return
+    path, filename = row
+    try:
+        f = await loop.run_in_executor(None, open, path, 'rb')
+    except OSError:
+        await send_json(writer, {'type': 'file_error', 'id': file_id, 'reason': 'not_found'})
+        return
+    size = os.fstat(f.fileno()).st_size
+    rng = parse_range(msg.get('range'), size)
+    if rng is None:
+        await loop.run_in_executor(None, f.close)
+        await send_json(writer, {'type': 'file_error', 'id': file_id, 'reason': 'bad_range', 'size': size})
+        return
+    start, length = rng
+    header = out.codec.encode({'type': 'file_data', 'id': file_id, 'filename': filename, 'size': size,
+                          'offset': start, 'length': length})
+    out.downloads += 1
+
+    async def stream(w):
+        t0 = time.perf_counter() if metrics.enabled else 0
+        try:
+            w.write(header)
+            await stream_file(w, f, start, length)
+        finally:
+            out.downloads -= 1
+            await loop.run_in_executor(None, f.close)
+        if metrics.enabled:
+            metrics.observe('chat_file_download_seconds', time.perf_counter() - t0)
+            metrics.inc('chat_file_download_bytes_total', length)
+
+    out.put_stream(stream)
 
 # --- Register / unregister clients ---
 async def register(writer, username):
-    clients[writer] = {'username': username, 'room': None, 'fernet': None}
+    clients[writer] = Session(username)
 
 async def unregister(writer):
-    info = clients.get(writer)
-    if not info:
-        return
-    room = info.get('room')
-    username = info.get('username')
-    if room and writer in rooms.get(room, set()):
-        rooms[room].remove(writer)
-        await broadcast(room, {'type': 'system', 'text': f"{username} left the room"})
+    session = clients.get(writer)
+    if session and session.room and rooms.leave(session.room, writer):
+        await broadcast(session.room, {'type': 'system', 'text': f"{session.username} left the room"})
+        if bus is not None:
+            bus.rooms_changed()
+    out = outbound.pop(writer, None)
+    if out is not None:
+        await out.close()
+        if out.dropped:
+            print('Slow client stats:', writer.get_extra_info('peername'), out.stats())
     try:
         writer.close()
         await writer.wait_closed()
@@ -155,74 +1767,653 @@ async def unregister(writer):
         pass
     clients.pop(writer, None)
 
+async def enter_room(writer, session, room):
+    # leave old room
+    old = session.room
+    if old and rooms.leave(old, writer):
+        await broadcast(old, {'type':'system', 'text': f"{session.username} left the room"})
+    session.room = room
+    rooms.join(room, writer)
+    if bus is not None:
+        bus.rooms_changed()
+
+async def resume_session(msg, writer):
+    # restore a dropped session from its token: user, room and the messages
+    # newer than last_id, without bcrypt or a full history replay
+    username = check_session_token(msg.get('token'))
+    if username is None:
+        await send_json(writer, {'type': 'resume_response', 'ok': False, 'reason': 'invalid_token'})
+        return
+    if writer in clients:
+        await send_json(writer, {'type': 'resume_response', 'ok': False, 'reason': 'already_authenticated'})
+        return
+    await register(writer, username)
+    room = msg.get('room')
+    if isinstance(room, str) and room:
+        await enter_room(writer, clients[writer], room)
+    else:
+        room = None
+    await send_json(writer, {'type': 'resume_response', 'ok': True, 'username': username, 'room': room,
+                             'token': issue_session_token(username)})
+    if room is None:
+        return
+    # ids start at 1, so last_id 0 means the client saw nothing: send a normal join page
+    since_id = message_id_arg(msg.get('last_id')) or None
+    resume = {'since_id': since_id} if since_id is not None else {}
+    history, has_more = await get_history_page(room, HISTORY_JOIN, since_id=since_id)
+    await send_json(writer, {'type': 'history', 'room': room, 'messages': history, 'has_more': has_more, **resume})
+    await broadcast(room, {'type': 'system', 'text': f"{username} joined the room"}, exclude_writer=writer)
+
+# --- Request dispatch ---
+async def dispatch(msg, reader, writer):
+    mtype = msg.get('type')
+    if mtype == 'hello':
+        out = outbound[writer]
+        codec = negotiate(msg) if not out.codec.binary else None
+        if codec is None:
+            await send_json(writer, {'type': 'hello_response', 'ok': False, 'codec': out.codec.name})
+            return
+        # the reply still goes out in line JSON; every later frame uses the new codec
+        out.put(out.codec.encode({'type': 'hello_response', 'ok': True, 'codec': codec.name,
+                                  'compress': codec.compress}), droppable=False)
+        out.codec = codec
+        return
+    if mtype == 'register':
+        try:
+            ok, reason = await run_auth(register_user, msg['username'], msg['password'])
+        except AuthBusy:
+            ok, reason = False, 'busy_retry'
+        await send_json(writer, {'type': 'register_response', 'ok': ok, 'reason': reason})
+        return
+    if mtype == 'login':
+        try:
+            pw_hash = await db_reader.run(get_password_hash, msg['username'])
+            ok = pw_hash is not None and await run_auth(verify_user, msg['password'], pw_hash)
+        except AuthBusy:
+            await send_json(writer, {'type': 'login_response', 'ok': False, 'reason': 'busy_retry'})
+            return
+        if ok:
+            await register(writer, msg['username'])
+            await send_json(writer, {'type': 'login_response', 'ok': True,
+                                     'token': issue_session_token(msg['username'])})
+        else:
+            await send_json(writer, {'type': 'login_response', 'ok': False, 'reason': 'bad_credentials'})
+        return
+    if mtype == 'resume':
+        await resume_session(msg, writer)
+        return
+    # other message types require authenticated client
+    if writer not in clients:
+        await send_json(writer, {'type': 'error', 'reason': 'not_authenticated'})
+        if mtype in ('file_meta', 'upload_chunk'):
+            # raw bytes follow that we would otherwise try to parse as frames
+            raise ConnectionError('upload from unauthenticated client')
+        return
+    session = clients[writer]
+    username = session.username
+    if mtype == 'join':
+        room = msg.get('room', 'main')
+        await enter_room(writer, session, room)
+        # later messages only need the room switch, not the history read
+        release_order()
+        # a rejoin after reconnect passes since_id and only gets what it missed
+        since_id = message_id_arg(msg.get('since_id'))
+        resume = {'since_id': since_id} if since_id is not None else {}
+        await send_json(writer, {'type': 'join_response', 'ok': True, 'room': room, **resume})
+        history, has_more = await get_history_page(room, page_limit(msg.get('limit'), HISTORY_JOIN), since_id=since_id)
+        await send_json(writer, {'type': 'history', 'room': room, 'messages': history, 'has_more': has_more, **resume})
+        await broadcast(room, {'type': 'system', 'text': f"{username} joined the room"}, exclude_writer=writer)
+    elif mtype == 'message':
+        room = session.room or 'main'
+        text = msg.get('text', '')
+        if text is None or isinstance(text, (int, float)):
+            # older clients sent bare numbers; store them as the text they display as
+            text = '' if text is None else str(text)
+        elif not isinstance(text, str):
+            await send_json(writer, {'type': 'error', 'reason': 'bad_text'})
+            return
+        # optional: decrypt if client sent encrypted payload; demo omitted
+        now = datetime.utcnow()
+        msg_id = store_message(room, username, text, now)
+        await broadcast_message(room, {'id': msg_id, 'sender': username, 'text': text, 'ts': now.isoformat(' ')},
+                                {'type': 'message', 'id': msg_id, 'room': room, 'sender': username,
+                                 'text': text, 'ts': now.isoformat()})
+    elif mtype == 'file_meta':
+        # client intends to send raw file bytes next; server will read exact size
+        meta = msg.get('meta')
+        # meta must include filename, size
+        await send_json(writer, {'type': 'file_ready'})
+        await handle_file_transfer({'filename': meta['filename'], 'size': meta['size'], 'room': session.room or 'main', 'sender': username}, reader, writer)
+    elif mtype == 'upload_start':
+        await start_upload(msg, writer, username, session.room or 'main')
+    elif mtype == 'upload_chunk':
+        await receive_upload_chunk(msg, reader, writer, username)
+    elif mtype == 'upload_finish':
+        await finish_upload(msg, writer, username, session.room or 'main')
+    elif mtype == 'file_get':
+        await send_file_download(msg, writer)
+    elif mtype == 'history_before':
+        room = msg.get('room') or session.room or 'main'
+        before_id = message_id_arg(msg.get('before_id'))
+        if before_id is None:
+            await send_json(writer, {'type': 'error', 'reason': 'bad_before_id'})
+            return
+        page, has_more = await get_history_page(room, page_limit(msg.get('limit'), HISTORY_JOIN), before_id=before_id,
+                                                archive=True)
+        await send_json(writer, {'type': 'history_page', 'room': room, 'before_id': before_id,
+                                 'messages': page, 'has_more': has_more})
+    elif mtype == 'history_after':
+        # the next catch-up page after a rejoin's since_id history came back with has_more
+        room = msg.get('room') or session.room or 'main'
+        since_id = message_id_arg(msg.get('since_id'))
+        if since_id is None:
+            await send_json(writer, {'type': 'error', 'reason': 'bad_since_id'})
+            return
+        page, has_more = await get_history_page(room, page_limit(msg.get('limit'), HISTORY_JOIN), since_id=since_id)
+        await send_json(writer, {'type': 'history', 'room': room, 'since_id': since_id,
+                                 'messages': page, 'has_more': has_more})
+    elif mtype == 'search':
+        await handle_search(msg, writer)
+    elif mtype == 'list_rooms':
+        names = rooms.names() if bus is None else bus.all_rooms()
+        await send_json(writer, {'type': 'rooms', 'rooms': names})
+    else:
+        await send_json(writer, {'type': 'error', 'reason': 'unknown_type'})
+
+# --- Rate limiting and admission control ---
+# Checked in the read loop before a request gets a pipeline slot. Buckets are
+# keyed by user (so extra connections buy nothing) and by room; with --workers
+# each process keeps its own. A rejected request gets an error with
+# retry_after and the connection is not read again until then, so a client
+# that ignores the hint is held back by TCP instead of costing a reply per frame.
+class RateLimiter:
+    __slots__ = ('buckets', 'swept')
+
+    def __init__(self):
+        self.buckets = {}     # (action, key) -> [tokens, monotonic time of last refill]
+        self.swept = time.monotonic()
+
+    def take(self, action, key):
+        # 0 if the action may go ahead, else seconds until a token is back
+        limit = RATE_LIMITS.get(action)
+        if limit is None:
+            return 0
+        burst, rate = limit
+        now = time.monotonic()
+        if now - self.swept > RATE_SWEEP_INTERVAL:
+            self.sweep(now)
+        bucket = self.buckets.get((action, key))
+        if bucket is None:
+            bucket = self.buckets[(action, key)] = [burst, now]
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / rate
+
+    def sweep(self, now):
+        # a bucket that has refilled is the same as no bucket
+        self.swept = now
+        for key, (tokens, stamp) in list(self.buckets.items()):
+            burst, rate = RATE_LIMITS.get(key[0], (0, 0))
+            if tokens + (now - stamp) * rate >= burst:
+                del self.buckets[key]
+
+rate_limiter = RateLimiter()
+RATE_ACTIONS = {'message': 'message', 'join': 'join', 'upload_start': 'upload', 'file_meta': 'upload'}
+
+def admit(msg, writer):
+    # seconds the request has to wait, 0 to let it through
+    action = RATE_ACTIONS.get(msg.get('type'))
+    session = clients.get(writer)
+    if action is None or session is None:
+        return 0
+    wait = rate_limiter.take(action, session.username)
+    if not wait and action == 'message':
+        wait = rate_limiter.take('room_message', session.room or 'main')
+    return wait
+
+async def reject(msg, writer, retry_after):
+    mtype = msg.get('type')
+    if metrics.enabled:
+        metrics.inc('chat_rate_limited_total', type=metrics.type_label(mtype))
+    # upload_start callers wait for an upload_* reply
+    reply = {'type': 'upload_error' if mtype == 'upload_start' else 'error', 'reason': 'rate_limited',
+             'request': mtype, 'retry_after': round(retry_after, 3)}
+    if mtype == 'upload_start':
+        reply['offset'] = 0
+    rid = msg.get('rid')
+    if isinstance(rid, (int, str)):
+        reply['rid'] = rid  # no request context here for send_json to take it from
+    await send_json(writer, reply)
+    if mtype == 'file_meta':
+        # raw bytes follow that we would otherwise try to parse as frames
+        raise ConnectionError('file_meta over the upload rate limit')
+    await asyncio.sleep(min(retry_after, RATE_PAUSE_MAX))
+
+conns_per_ip = {}
+
+def claim_ip_slot(ip):
+    count = conns_per_ip.get(ip, 0)
+    if MAX_CONNS_PER_IP is not None and count >= MAX_CONNS_PER_IP and ip not in CONN_LIMIT_EXEMPT:
+        return False
+    conns_per_ip[ip] = count + 1
+    return True
+
+def release_ip_slot(ip):
+    count = conns_per_ip.pop(ip) - 1
+    if count:
+        conns_per_ip[ip] = count
+
+# --- Traffic capture ---
+# With CAPTURE_FILE set (or --capture), every frame handle_client reads is
+# logged as a gzip JSON line [ms since start, connection number, frame], plus
+# [ms, connection, null] when the connection closes. Raw upload bytes are not
+# kept, only the sizes their headers carry; passwords and tokens are blanked.
+# Records are buffered on the loop and written from the executor.
+class Capture:
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        self.file.write(json.dumps({'capture': 1, 'started_at': datetime.utcnow().isoformat(), 'pid': os.getpid()}) + '\n')
+        self.t0 = time.monotonic()
+        self.pending = []
+        self.connections = 0
+        self.lock = threading.Lock()  # a write may still be running in the executor at shutdown
+
+    def connect(self):
+        self.connections += 1
+        return self.connections
+
+    def record(self, conn, msg):
+        frame = scrub_frame(msg) if msg is not None else None
+        self.pending.append([round((time.monotonic() - self.t0) * 1000, 3), conn, frame])
+
+    def take(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def write(self, records):
+        # executor
+        if records:
+            data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+            with self.lock:
+                if not self.file.closed:
+                    self.file.write(data)
+                    self.file.flush()
+
+    def close(self):
+        self.write(self.take())
+        with self.lock:
+            self.file.close()
+
+capture = None
+
+def scrub_frame(msg):
+    mtype = msg.get('type')
+    if mtype in ('login', 'register'):
+        return dict(msg, password='')
+    if mtype == 'resume':
+        # replay logs the user in again instead
+        return dict(msg, token='', username=check_session_token(msg.get('token')))
+    if not CAPTURE_TEXT:
+        if mtype == 'message' and isinstance(msg.get('text'), str):
+            return dict(msg, text='x' * len(msg['text']))
+        if mtype == 'search' and isinstance(msg.get('query'), str):
+            return dict(msg, query='x' * len(msg['query']))
+    return msg
+
+async def capture_loop():
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await asyncio.sleep(CAPTURE_FLUSH_INTERVAL)
+            await loop.run_in_executor(None, capture.write, capture.take())
+    finally:
+        capture.close()
+
+# --- Profiling ---
+# --profile starts a watchdog thread that beats against the event loop: when
+# the loop has not run a callback for LOOP_BLOCK_MS, the loop thread's stack is
+# sampled until it recovers, the first sample goes to stalls.log and all of
+# them to stalls.folded. Requests slower than SLOW_REQUEST_MS are written to
+# slow_requests.jsonl with the time spent per metrics probe. SIGUSR1 (always
+# installed) samples every thread for PROFILE_SECONDS into profile-*.folded;
+# the --workers parent forwards it to every worker.
+# The .folded files are collapsed stacks, one 'a;b;c count' per line, as read
+# by flamegraph.pl, speedscope and inferno.
+def fold_stack(frame, root):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.append(root)
+    return ';'.join(reversed(names))
+
+def write_folded(path, counts):
+    with open(path, 'a') as f:
+        for stack, count in counts.items():
+            f.write(f'{stack} {count}\n')
+
+class LoopWatchdog:
+    def __init__(self, loop, block_ms=LOOP_BLOCK_MS, directory=PROFILE_DIR):
+        self.loop = loop
+        self.block = block_ms / 1000
+        self.interval = self.block / 4
+        self.directory = directory
+        self.loop_thread = threading.get_ident()
+        self.tick = time.monotonic()
+        self.lines = queue.Queue()      # (file name, line) written by the watchdog thread
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.loop.call_soon(self._beat)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def log(self, name, line):
+        self.lines.put((name, line))
+
+    def _beat(self):
+        self.tick = time.monotonic()
+        if not self.stopped.is_set():
+            self.loop.call_later(self.interval, self._beat)
+
+    def _watch(self):
+        stall_start = None
+        samples = {}
+        first = None
+        while not self.stopped.wait(self.interval):
+            last_beat = self.tick
+            if time.monotonic() - last_beat > self.block:
+                frame = sys._current_frames().get(self.loop_thread)
+                if stall_start is None:
+                    stall_start = last_beat
+                    samples = {}
+                    first = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                if frame is not None:
+                    stack = fold_stack(frame, 'event-loop')
+                    samples[stack] = samples.get(stack, 0) + 1
+            elif stall_start is not None:
+                self._stall(last_beat - stall_start - self.interval, first, samples)
+                stall_start = None
+            self._flush()
+        self._flush()
+
+    def _stall(self, seconds, first, samples):
+        if metrics.enabled:
+            metrics.observe('chat_loop_stall_seconds', seconds)
+        stamp = datetime.utcnow().isoformat()
+        with open(os.path.join(self.directory, 'stalls.log'), 'a') as f:
+            f.write(f'{stamp} event loop blocked for ~{seconds * 1000:.0f} ms; first sampled stack:\n{first}\n')
+        write_folded(os.path.join(self.directory, 'stalls.folded'), samples)
+        print(f'Event loop blocked for ~{seconds * 1000:.0f} ms (see {self.directory}/stalls.log)')
+
+    def _flush(self):
+        files = {}
+        while True:
+            try:
+                name, line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+            files.setdefault(name, []).append(line)
+        for name, lines in files.items():
+            with open(os.path.join(self.directory, name), 'a') as f:
+                f.write(''.join(line + '\n' for line in lines))
+
+loop_watchdog = None
+
+def log_slow_request(msg, req, started):
+    now = time.perf_counter()
+    total = now - req.received
+    if total * 1000 < SLOW_REQUEST_MS:
+        return
+    session = clients.get(req.writer)
+    room = msg.get('room') or (session.room if session else None)
+    loop_watchdog.log('slow_requests.jsonl', json.dumps({
+        'ts': datetime.utcnow().isoformat(), 'type': msg.get('type'), 'room': room,
+        'user': session.username if session else None, 'rid': req.rid,
+        'total_ms': round(total * 1000, 2),
+        'waiting_ms': round((started - req.received) * 1000, 2),  # for a pipeline slot / the lane
+        'phases_ms': {k: round(v * 1000, 2) for k, v in req.phases.items()},
+    }))
+
+_sampling = threading.Lock()
+
+def sample_stacks(seconds=PROFILE_SECONDS, hz=PROFILE_SAMPLE_HZ, directory=PROFILE_DIR):
+    # runs on its own thread; samples every thread except itself
+    if not _sampling.acquire(blocking=False):
+        return
+    try:
+        os.makedirs(directory, exist_ok=True)
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stack = fold_stack(frame, names.get(ident, f'thread-{ident}'))
+                    counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(1 / hz)
+        path = os.path.join(directory, f'profile-{os.getpid()}-{datetime.utcnow():%Y%m%dT%H%M%S}.folded')
+        write_folded(path, counts)
+        print('Wrote profile', path)
+    finally:
+        _sampling.release()
+
+def on_sigusr1(signum, frame):
+    # a plain signal handler, not loop.add_signal_handler: it has to fire
+    # while the loop is the thing that is stuck
+    threading.Thread(target=sample_stacks, args=(PROFILE_SECONDS, PROFILE_SAMPLE_HZ, PROFILE_DIR),
+                     name='profile-sampler', daemon=True).start()
+
+# --- Request pipelining ---
+# Each request runs in its own task, up to PIPELINE_MAX per connection, and a
+# request carrying a client-assigned 'rid' gets it echoed on every reply.
+# Requests that share a lane start in arrival order and each waits for the one
+# before it to release the lane (at the end, or earlier via release_order());
+# requests without a lane run freely. Until the connection is authenticated
+# every request takes the session lane, so nothing overtakes a login still on
+# the auth pool. Requests that read raw bytes after their frame, or change how
+# frames are read, hold the reader until release_reader().
+SESSION_LANE = frozenset(('login', 'resume', 'join', 'message', 'file_meta'))
+READER_TYPES = frozenset(('hello', 'file_meta', 'upload_chunk'))
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+class Request:
+    __slots__ = ('rid', 'writer', 'ordered', 'reader_free', 'received', 'phases')
+
+    def __init__(self, rid, writer):
+        self.rid = rid
+        self.writer = writer
+        self.ordered = asyncio.Event()
+        self.reader_free = asyncio.Event()
+        self.received = time.perf_counter()
+        self.phases = {} if loop_watchdog is not None else None  # phase -> seconds, for the slow log
+
+def release_order():
+    req = current_request.get()
+    if req is not None:
+        req.ordered.set()
+
+def release_reader():
+    req = current_request.get()
+    if req is not None:
+        req.reader_free.set()
+
+def request_lane(msg, authenticated):
+    # upload_chunk/upload_finish need no lane: they take the upload's lock right
+    # after the reader hands over, so they queue on it in arrival order while
+    # the next chunk is already being read off the socket
+    if msg.get('type') in SESSION_LANE or not authenticated:
+        return 'session'
+    return None
+
+class Pipeline:
+    __slots__ = ('reader', 'writer', 'slots', 'lanes', 'tasks')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.slots = asyncio.Semaphore(PIPELINE_MAX)
+        self.lanes = {}       # lane -> Request that the next one in the lane waits for
+        self.tasks = set()
+
+    async def submit(self, msg):
+        rid = msg.get('rid')
+        req = Request(rid if isinstance(rid, (int, str)) else None, self.writer)
+        await self.slots.acquire()
+        lane = request_lane(msg, self.writer in clients)
+        prev = self.lanes.get(lane) if lane is not None else None
+        if lane is not None:
+            self.lanes[lane] = req
+        task = asyncio.create_task(self._run(msg, req, prev, lane))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if msg.get('type') in READER_TYPES:
+            await req.reader_free.wait()
+
+    async def _run(self, msg, req, prev, lane):
+        current_request.set(req)
+        try:
+            if prev is not None:
+                await prev.ordered.wait()
+            t0 = time.perf_counter() if metrics.enabled else 0
+            await dispatch(msg, self.reader, self.writer)
+            if metrics.enabled:
+                metrics.observe('chat_request_seconds', time.perf_counter() - t0, type=metrics.type_label(msg.get('type')))
+            if req.phases is not None:
+                log_slow_request(msg, req, t0)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # same as an error in the read loop: the connection goes
+            print('Connection error:', e)
+            self.writer.transport.abort()
+        finally:
+            req.ordered.set()
+            req.reader_free.set()
+            if lane is not None and self.lanes.get(lane) is req:
+                del self.lanes[lane]
+            self.slots.release()
+
+    async def drain(self):
+        if self.tasks:
+            done, pending = await asyncio.wait(set(self.tasks), timeout=PIPELINE_DRAIN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+
 # --- Main client handler ---
 async def handle_client(reader, writer):
     peer = writer.get_extra_info('peername')
+    ip = peer[0] if isinstance(peer, tuple) else None
+    if not claim_ip_slot(ip):
+        if metrics.enabled:
+            metrics.inc('chat_connections_refused_total')
+        writer.write(encode_json({'type': 'error', 'reason': 'too_many_connections', 'retry_after': CONN_RETRY_AFTER}))
+        writer.close()
+        return
     print('Client connected:', peer)
+    if SOCKET_WRITE_BUFFER:
+        writer.transport.set_write_buffer_limits(high=SOCKET_WRITE_BUFFER)
+    conn_id = capture.connect() if capture is not None else None
+    out = outbound[writer] = Outbound(writer, OUTBOUND_MAX_BYTES, OUTBOUND_POLICY)
+    out.start()
+    pipeline = Pipeline(reader, writer)
     try:
-        # We'll read line-delimited JSON messages
+        # line-delimited JSON until a hello switches the connection to binary frames
         while True:
-            line = await reader.readline()
-            if not line:
-                break
             try:
-                msg = json.loads(line.decode('utf-8'))
-            except Exception as e:
-                await send_json(writer, {'type': 'error', 'reason': 'invalid_json'})
+                msg, size = await out.codec.read(reader, CLIENT_FRAME_MAX)
+            except FrameError:
+                await send_json(writer, {'type': 'error', 'reason': 'frame_too_large', 'max': CLIENT_FRAME_MAX})
+                break
+            except ValueError:
+                await send_json(writer, {'type': 'error', 'reason': 'invalid_frame' if out.codec.binary else 'invalid_json'})
                 continue
-            mtype = msg.get('type')
-            if mtype == 'register':
-                ok, reason = register_user(msg['username'], msg['password'])
-                await send_json(writer, {'type': 'register_response', 'ok': ok, 'reason': reason})
-            elif mtype == 'login':
-                if verify_user(msg['username'], msg['password']):
-                    await register(writer, msg['username'])
-                    await send_json(writer, {'type': 'login_response', 'ok': True})
-                else:
-                    await send_json(writer, {'type': 'login_response', 'ok': False, 'reason': 'bad_credentials'})
-            else:
-                # other message types require authenticated client
-                if writer not in clients:
-                    await send_json(writer, {'type': 'error', 'reason': 'not_authenticated'})
-                    continue
-                info = clients[writer]
-                username = info['username']
-                if mtype == 'join':
-                    room = msg.get('room', 'main')
-                    # leave old room
-                    old = info.get('room')
-                    if old and writer in rooms.get(old, set()):
-                        rooms[old].remove(writer)
-                        await broadcast(old, {'type':'system', 'text': f"{username} left the room"})
-                    info['room'] = room
-                    rooms.setdefault(room, set()).add(writer)
-                    await send_json(writer, {'type': 'join_response', 'ok': True, 'room': room})
-                    # send recent history
-                    history = get_recent_messages(room)
-                    await send_json(writer, {'type': 'history', 'room': room, 'messages': history})
-                    await broadcast(room, {'type': 'system', 'text': f"{username} joined the room"}, exclude_writer=writer)
-                elif mtype == 'message':
-                    room = info.get('room') or 'main'
-                    text = msg.get('text', '')
-                    # optional: decrypt if client sent encrypted payload; demo omitted
-                    store_message(room, username, text)
-                    await broadcast(room, {'type': 'message', 'room': room, 'sender': username, 'text': text, 'ts': datetime.utcnow().isoformat()})
-                elif mtype == 'file_meta':
-                    # client intends to send raw file bytes next; server will read exact size
-                    meta = msg.get('meta')
-                    # meta must include filename, size
-                    await send_json(writer, {'type': 'file_ready'})
-                    await handle_file_transfer({'filename': meta['filename'], 'size': meta['size'], 'room': info.get('room','main'), 'sender': username}, reader, writer)
-                elif mtype == 'list_rooms':
-                    await send_json(writer, {'type': 'rooms', 'rooms': list(rooms.keys())})
-                else:
-                    await send_json(writer, {'type': 'error', 'reason': 'unknown_type'})
+            if msg is None:
+                break
+            if not isinstance(msg, dict):
+                await send_json(writer, {'type': 'error', 'reason': 'invalid_frame'})
+                continue
+            if metrics.enabled:
+                metrics.inc('chat_received_bytes_total', size, codec=out.codec.label)
+            if capture is not None:
+                capture.record(conn_id, msg)
+            retry_after = admit(msg, writer)
+            if retry_after:
+                await reject(msg, writer, retry_after)
+                continue
+            await pipeline.submit(msg)
     except Exception as e:
         print('Connection error:', e)
     finally:
+        await pipeline.drain()
         await unregister(writer)
+        release_ip_slot(ip)
+        if capture is not None:
+            capture.record(conn_id, None)
         print('Client disconnected:', peer)
 
+# --- Metrics endpoint ---
+def collect_gauges():
+    queued = [out.queued_bytes for out in outbound.values()]
+    gauges = [
+        ('chat_connections', (), len(outbound)),
+        ('chat_clients_authenticated', (), len(clients)),
+        ('chat_rooms', (), len(rooms)),
+        ('chat_outbound_queued_bytes', (), sum(queued)),
+        ('chat_outbound_queued_bytes_max', (), max(queued, default=0)),
+        ('chat_outbound_lag_seconds_max', (), max((out.last_lag for out in outbound.values()), default=0)),
+        ('chat_auth_pending', (), _auth_pending),
+        ('chat_db_writer_queue', (), db_writer.queue.qsize() if db_writer else 0),
+    ]
+    for key, value in history_cache.stats().items():
+        gauges.append((f'chat_history_cache_{key}', (), value))
+    largest = sorted(rooms.items(), key=lambda kv: len(kv[1]), reverse=True)[:METRICS_MAX_ROOMS]
+    for room, members in largest:
+        gauges.append(('chat_room_members', (('room', room),), len(members)))
+    return gauges
+
+async def handle_metrics(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[1] in (b'/', b'/metrics'):
+            body = metrics.render(collect_gauges()).encode('utf-8')
+            head = b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+        else:
+            body = b'not found\n'
+            head = b'HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n'
+        writer.write(head + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(worker_id=None):
+    if METRICS_PORT is None:
+        return None
+    metrics.enabled = True
+    # each worker process gets its own port: METRICS_PORT + worker id
+    port = METRICS_PORT + (worker_id or 0)
+    server = await asyncio.start_server(handle_metrics, METRICS_HOST, port)
+    print(f'Metrics on http://{METRICS_HOST}:{port}/metrics')
+    return server
+
 # --- TLS context (self-signed allowed for testing) ---
 def make_ssl_context():
     if not os.path.exists(TLS_CERT) or not os.path.exists(TLS_KEY):
@@ -232,17 +2423,202 @@ def make_ssl_context():
     context.load_cert_chain(certfile=TLS_CERT, keyfile=TLS_KEY)
     return context
 
-async def main_server():
-    init_db()
+async def main_server(worker_id=None, workers=1, bus_path=None):
+    global db_writer, db_reader, bus, session_fernet, capture, loop_watchdog, history_cache
+    if worker_id is None:
+        init_db()
+        init_file_dirs()
+        cleanup_partial_uploads()
+    session_fernet = load_session_key(SESSION_KEY_FILE)
+    history_cache = HistoryCache(HISTORY_LIMIT, HISTORY_CACHE_BYTES)
+    db_writer = DBWriter(DB_FILE, DB_BATCH_ROWS, DB_BATCH_MS, DB_SYNCHRONOUS)
+    db_writer.start(worker_id or 0, workers)
+    db_reader = DBReadPool(DB_FILE, DB_READERS)
+    if bus_path:
+        bus = RoomBus(bus_path, worker_id)
+        await bus.start()
     sslctx = make_ssl_context()
-    server = await asyncio.start_server(handle_client, HOST, PORT, ssl=sslctx)
+    server = await asyncio.start_server(handle_client, HOST, PORT, ssl=sslctx, reuse_port=workers > 1,
+                                        limit=CLIENT_FRAME_MAX, backlog=LISTEN_BACKLOG)
     addr = server.sockets[0].getsockname()
-    print(f'Serving on {addr}')
-    async with server:
-        await server.serve_forever()
+    if worker_id is None:
+        print(f'Serving on {addr}')
+    else:
+        print(f'Worker {worker_id} (pid {os.getpid()}) serving on {addr}')
+    metrics_server = await start_metrics_server(worker_id)
+    janitor = asyncio.create_task(upload_janitor())
+    # one sweeper is enough when several workers share the store
+    gc_task = asyncio.create_task(blob_gc()) if not worker_id else None
+    retention = asyncio.create_task(retention_loop()) if not worker_id else None
+    capture_task = None
+    if CAPTURE_FILE:
+        # one file per worker; chat_replay.py merges them
+        capture = Capture(CAPTURE_FILE if worker_id is None else f'{CAPTURE_FILE}.{worker_id}')
+        capture_task = asyncio.create_task(capture_loop())
+        print('Capturing traffic to', capture.path)
+    if PROFILE:
+        # the metrics probes double as the slow-request phase timers
+        metrics.enabled = True
+        loop_watchdog = LoopWatchdog(asyncio.get_running_loop(), LOOP_BLOCK_MS, PROFILE_DIR)
+        loop_watchdog.start()
+        print(f'Profiling: stalls over {LOOP_BLOCK_MS} ms and requests over {SLOW_REQUEST_MS} ms go to {PROFILE_DIR}/')
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, on_sigusr1)
+    try:
+        # stop cleanly on SIGTERM too, so the writer gets to flush its queue
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        janitor.cancel()
+        if gc_task is not None:
+            gc_task.cancel()
+        if retention is not None:
+            retention.cancel()
+        if capture_task is not None:
+            capture_task.cancel()
+        if loop_watchdog is not None:
+            loop_watchdog.stop()
+        if metrics_server is not None:
+            metrics_server.close()
+        if bus is not None:
+            bus.close()
+        shutdown_auth_executor()
+        db_reader.close()
+        db_writer.close()
+        print('History cache:', history_cache.stats())
+
+# --- Event loop and settings ---
+def use_uvloop():
+    if EVENT_LOOP not in ('auto', 'uvloop', 'asyncio'):
+        raise SystemExit(f'EVENT_LOOP must be auto, uvloop or asyncio, not {EVENT_LOOP!r}')
+    if EVENT_LOOP == 'uvloop' and uvloop is None:
+        raise SystemExit('EVENT_LOOP is uvloop but uvloop is not installed (pip install uvloop)')
+    return uvloop is not None and EVENT_LOOP != 'asyncio'
+
+def run_loop(coro):
+    if not use_uvloop():
+        return asyncio.run(coro)
+    if hasattr(uvloop, 'run'):
+        return uvloop.run(coro)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # uvloop < 0.18
+    return asyncio.run(coro)
+
+def print_settings(sources):
+    loop_name = f'uvloop {uvloop.__version__}' if use_uvloop() else 'asyncio'
+    print(f'Chat server on Python {sys.version.split()[0]}, event loop: {loop_name}')
+    for line in format_settings(globals(), SETTINGS, sources, REPORT_SETTINGS):
+        print(line)
+
+# --- Multi-process mode ---
+def run_workers(workers):
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('--workers needs a POSIX system with SO_REUSEPORT')
+    init_db()
+    init_file_dirs()
+    cleanup_partial_uploads()
+    load_session_key(SESSION_KEY_FILE)  # create the shared key before the workers race for it
+    bus_path = os.path.abspath(BUS_SOCKET)
+    if os.path.exists(bus_path):
+        os.unlink(bus_path)
+    bus_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_sock.bind(bus_path)
+    bus_sock.listen()
+    sys.stdout.flush()
+    if hasattr(signal, 'SIGUSR1'):
+        # workers ignore SIGUSR1 until main_server installs its own handler
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            bus_sock.close()
+            code = 0
+            try:
+                run_loop(main_server(worker_id, workers, bus_path))
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                pass
+            except Exception as e:
+                print(f'Worker {worker_id} failed:', e)
+                code = 1
+            sys.stdout.flush()
+            os._exit(code)
+        pids.append(pid)
+
+    def forward_signal(signum, frame):
+        # the parent only relays the bus; the stacks worth sampling are the workers'
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, forward_signal)
+    try:
+        run_loop(run_bus_hub(bus_sock))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        if os.path.exists(bus_path):
+            os.unlink(bus_path)
+    print('Server stopped')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the listening port (POSIX only)')
+    parser.add_argument('--rebuild-search', action='store_true',
+                        help='rebuild the full-text search index from the messages table and exit')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='compact the database with a full VACUUM (enables incremental vacuum on older databases) and exit')
+    parser.add_argument('--config', metavar='PATH',
+                        help='JSON file of settings (default: server_config.json when present, or $CHAT_CONFIG)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override one setting, e.g. --set DB_READERS=8 (repeatable; beats the file and CHAT_<NAME>)')
+    parser.add_argument('--host', help='address to listen on (HOST)')
+    parser.add_argument('--port', type=int, help='port to listen on (PORT)')
+    parser.add_argument('--print-config', action='store_true',
+                        help='print the effective settings as JSON and exit')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='record inbound frames to PATH (gzip JSON lines) for chat_replay.py')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'log event-loop stalls and slow requests to {PROFILE_DIR}/ (SIGUSR1 dumps work either way)')
+    args = parser.parse_args()
+    config_path = args.config or os.environ.get('CHAT_CONFIG')
     try:
-        asyncio.run(main_server())
-    except KeyboardInterrupt:
-        print('Server stopped')
+        overrides = parse_assignments(args.set)
+        for name, value in (('HOST', args.host), ('PORT', args.port), ('CAPTURE_FILE', args.capture),
+                            ('PROFILE', args.profile or None)):
+            if value is not None:
+                overrides.append((name, value))
+        sources = apply_settings(globals(), SETTINGS, config_path or 'server_config.json',
+                                 required=config_path is not None, overrides=overrides,
+                                 types=SETTING_TYPES)
+    except ConfigError as e:
+        parser.error(str(e))
+    if args.print_config:
+        print(dump_settings(globals(), SETTINGS))
+        raise SystemExit(0)
+    print_settings(sources)
+    if args.rebuild_search:
+        rebuild_search_index()
+    elif args.vacuum:
+        vacuum_db()
+    elif args.workers > 1:
+        run_workers(args.workers)
+    else:
+        try:
+            run_loop(main_server())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print('Server stopped')